@@ -0,0 +1,792 @@
+# Copyright (C) 2015 Edward Wijaya
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Precomputed aggregates of the On Time Flight Data
+
+For every origin airport the cube keeps one aggregate for all of its
+flights, plus one aggregate per value of each group dimension
+(dest, unique_carrier, day_of_week, distance).
+An aggregate holds what both endpoints need :
+- the number of flights and of cancelled flights
+- the number, minimum and maximum of the negative arrival delays
+- the minutes late of every flight with an arrival delay, as a sorted
+  array, so shares of flights over a threshold and percentiles are
+  found by binary search. Flights added at runtime are inserted in a
+  short sorted array of recent delays, copied on write, which is merged
+  into the sorted ones once it holds 16 times the square root of their
+  number: adding a flight moves O(sqrt n) items instead of half of the
+  array, and queries bisect both runs without sorting anything
+- a DelaySketch of the same minutes late, which estimates quantiles in
+  bounded memory and merges with the sketches of other groups
+
+Arrival delays are negative for late flights, so the minutes late of a
+flight are the opposite of its arrival delay.
+
+Group values are kept raw (dest code, day number, distance in miles),
+the endpoints turn them into labels when answering. Distances are put
+into ranges by DistanceBuckets, either of a fixed width or along
+explicit edges.
+
+Aggregates of partitions loaded separately are combined with merge.
+
+An AggregateTable lays the aggregates of every origin out in flat
+arrays, the way they are written to a snapshot : counters, sorted
+delays and sketch buckets of all the aggregates one after the other,
+and the group values of every origin sorted for binary search.
+A cube loaded from a snapshot reads its aggregates from such a table,
+in place when the snapshot is mapped, and only builds objects for the
+aggregates a request asks for. An origin is copied out of the table
+when flights are added to it.
+
+Groupings across several dimensions (e.g. dest x unique_carrier) are
+not precomputed, aggregate_rows computes them in one pass over the
+flights of an origin, keyed by tuples of raw values.
+
+"""
+
+import math
+from array import array
+from bisect import bisect_left
+from bisect import bisect_right
+from bisect import insort
+from itertools import chain
+from flight_sketch import DelaySketch
+
+recent_delays_min = 64  # recent delays of an aggregate buffered at least before they are merged
+recent_delays_factor = 16  # recent delays buffered per square root of the number of sorted delays
+group_dimensions = ('dest', 'unique_carrier', 'day_of_week', 'distance')
+# Arrays of an AggregateTable, all of typecode 'i'
+table_fields = ('origin_codes', 'origin_aggregates', 'group_offsets', 'group_values', 'group_aggregates',
+                'counts', 'cancelled', 'delay_counts', 'min_delays', 'max_delays', 'delay_offsets', 'delays',
+                'zero_counts', 'sketch_offsets', 'sketch_indexes', 'sketch_counts')
+
+
+def merged_item(first, second, index):
+    """
+    Returns an item of the sorted merge of two sorted arrays, without merging them.
+    :param first: Sorted array.
+    :param second: Sorted array.
+    :param index: Index of the item in the merge, below the sum of their lengths.
+    :return: Item at the index.
+    """
+    # Binary search of the number of items taken from first among the index + 1 smallest
+    count = index + 1
+    low, high = max(0, count - len(second)), min(count, len(first))
+    while low < high:
+        taken = (low + high) // 2
+        if second[count - taken - 1] > first[taken]:
+            low = taken + 1
+        else:
+            high = taken
+    if low == 0:
+        return second[count - 1]
+    if low == count:
+        return first[count - 1]
+    return max(first[low - 1], second[count - low - 1])
+
+
+def writable_array(values):
+    """
+    Returns the values of an array, or of a read-only view mapped from a snapshot,
+    as an array that can be appended to.
+    :param values: array, or memoryview cast to the typecode of the values.
+    :return: The array itself, or an array holding a copy of the view.
+    """
+    if isinstance(values, array):
+        return values
+    copy = array(values.format)
+    copy.frombytes(values.tobytes())
+    return copy
+
+
+class GroupAggregate(object):
+    """
+    Flights count, cancellations and arrival delays of a group of flights.
+    """
+    __slots__ = ('count', 'cancelled', 'delay_count', 'min_delay', 'max_delay', 'delays', 'recent', 'sketch')
+
+    def __init__(self, keep_delays=True, keep_sketch=True):
+        self.count = 0
+        self.cancelled = 0
+        self.delay_count = 0
+        self.min_delay = None
+        self.max_delay = None
+        self.delays = array('i') if keep_delays else None  # sorted minutes late, None when not kept
+        # (delays, sorted array of the minutes late added since they were merged), only valid with these delays
+        self.recent = None
+        self.sketch = DelaySketch() if keep_sketch else None  # sketch of the minutes late, None when not kept
+
+    def add(self, arr_delay, cancelled, sort=True):
+        """
+        Adds one flight to the aggregate.
+        :param arr_delay: Arrival delay of the flight, None when missing.
+        :param cancelled: 1 when the flight was cancelled, 0 otherwise.
+        :param sort: Whether to keep the delays sorted, otherwise sort_delays() has to be called.
+        """
+        self.count += 1
+        if cancelled == 1:
+            self.cancelled += 1
+        if arr_delay is not None:
+            if self.delays is not None:
+                if sort:
+                    self.add_recent(-arr_delay)
+                else:
+                    self.delays.append(-arr_delay)
+            if self.sketch is not None:
+                self.sketch.add(-arr_delay)
+            if arr_delay < 0:
+                if self.delay_count == 0:
+                    self.min_delay = self.max_delay = arr_delay
+                elif arr_delay < self.min_delay:
+                    self.min_delay = arr_delay
+                elif arr_delay > self.max_delay:
+                    self.max_delay = arr_delay
+                self.delay_count += 1
+
+    def add_recent(self, minutes):
+        """
+        Inserts the minutes late of a flight in the recent delays,
+        merged into the sorted delays once there are enough of them.
+        :param minutes: Minutes late.
+        """
+        delays = self.delays
+        recent = self.recent
+        # Copied on write, readers holding the previous recent delays go on with them
+        values = recent[1][:] if recent is not None and recent[0] is delays else array('i')
+        insort(values, minutes)
+        if len(values) > max(recent_delays_min, recent_delays_factor * int(math.sqrt(len(delays)))):
+            self.delays = array('i', sorted(chain(delays, values)))
+            self.recent = None
+        else:
+            self.recent = (delays, values)
+
+    def delay_runs(self):
+        """
+        Returns the delays kept as two sorted runs, the ones merged and the recent ones.
+        :return: Tuple of (sorted delays, sorted recent delays), None when the delays are not kept.
+        """
+        recent = self.recent    # read first, it only holds the recent delays of the delays read next
+        delays = self.delays
+        if delays is None or recent is None or recent[0] is not delays:
+            return None if delays is None else (delays, ())
+        return delays, recent[1]
+
+    def sorted_delays(self):
+        """
+        Returns the delays kept as one sorted array, merging the recent ones.
+        :return: Sorted array of minutes late, None when the delays are not kept.
+        """
+        runs = self.delay_runs()
+        if runs is None:
+            return None
+        delays, recent = runs
+        if not recent:
+            return delays
+        return array('i', sorted(chain(delays, recent)))
+
+    def merge(self, other, sort=True):
+        """
+        Adds the flights of another aggregate to this one.
+        :param other: GroupAggregate to merge.
+        :param sort: Whether to keep the delays sorted, otherwise sort_delays() has to be called.
+        """
+        self.count += other.count
+        self.cancelled += other.cancelled
+        if other.delay_count:
+            if self.delay_count == 0:
+                self.min_delay = other.min_delay
+                self.max_delay = other.max_delay
+            else:
+                self.min_delay = min(self.min_delay, other.min_delay)
+                self.max_delay = max(self.max_delay, other.max_delay)
+            self.delay_count += other.delay_count
+        other_runs = other.delay_runs() if self.delays is not None else None
+        if other_runs is not None:
+            if sort:
+                self.delays = array('i', sorted(chain(self.sorted_delays(), *other_runs)))
+                self.recent = None
+            else:
+                for delays in other_runs:
+                    self.delays.extend(delays)
+        if self.sketch is not None and other.sketch is not None:
+            self.sketch.merge(other.sketch)
+
+    def sort_delays(self):
+        """
+        Sorts the delays added with sort=False.
+        """
+        if self.delays is not None:
+            self.delays = array('i', sorted(chain(*self.delay_runs())))
+            self.recent = None
+
+    def share_late(self, minutes):
+        """
+        Returns the share of the flights with an arrival delay that arrived more than some minutes late.
+        :param minutes: Minutes late.
+        :return: Share between 0 and 1, None when no flight has an arrival delay.
+        """
+        runs = self.delay_runs()
+        total = sum(len(delays) for delays in runs) if runs else 0
+        if not total:
+            return None
+        return float(total - sum(bisect_right(delays, minutes) for delays in runs)) / total
+
+    def share_on_time(self, minutes):
+        """
+        Returns the share of the flights with an arrival delay that arrived at most some minutes late.
+        :param minutes: Minutes late.
+        :return: Share between 0 and 1, None when no flight has an arrival delay.
+        """
+        runs = self.delay_runs()
+        total = sum(len(delays) for delays in runs) if runs else 0
+        if not total:
+            return None
+        return float(sum(bisect_right(delays, minutes) for delays in runs)) / total
+
+    def percentile(self, percent):
+        """
+        Returns the minutes late of a percentile of the flights, by nearest rank.
+        :param percent: Percentile between 0 and 100.
+        :return: Minutes late, negative when early, None when no flight has an arrival delay.
+        """
+        runs = self.delay_runs()
+        total = sum(len(delays) for delays in runs) if runs else 0
+        if not total:
+            return None
+        rank = int(math.ceil(percent / 100.0 * total))
+        return merged_item(runs[0], runs[1], min(max(rank - 1, 0), total - 1))
+
+    def estimate_percentile(self, percent):
+        """
+        Estimates the minutes late of a percentile of the flights from the sketch.
+        :param percent: Percentile between 0 and 100.
+        :return: Minutes late rounded to the minute, None when no flight has an arrival delay.
+        """
+        minutes = self.sketch.quantile(percent / 100.0)
+        if minutes is None:
+            return None
+        return int(round(minutes))
+
+    def state(self, delays=None):
+        """
+        Returns the aggregate as a plain list, e.g. to be sent across processes.
+        :param delays: List the sorted delays are appended to, as they are kept apart from the state.
+        :return: List of count, cancelled, delay_count, min_delay, max_delay and the sketch state.
+        """
+        if delays is not None:
+            delays.append(self.sorted_delays())
+        return [self.count, self.cancelled, self.delay_count, self.min_delay, self.max_delay,
+                None if self.sketch is None else self.sketch.state()]
+
+    @classmethod
+    def from_state(cls, state, delays=None):
+        """
+        Rebuilds an aggregate from the list returned by state().
+        :param state: List of count, cancelled, delay_count, min_delay, max_delay and the sketch state.
+        :param delays: Iterator of the sorted delays, in the order they were appended by state().
+        :return: GroupAggregate.
+        """
+        aggregate = cls()
+        aggregate.count, aggregate.cancelled, aggregate.delay_count, aggregate.min_delay, aggregate.max_delay = \
+            state[:5]
+        if delays is not None:
+            aggregate.delays = next(delays)
+        if state[5] is not None:
+            aggregate.sketch = DelaySketch.from_state(state[5])
+        return aggregate
+
+
+class OriginAggregates(object):
+    """
+    Aggregates of the flights flying from one origin airport.
+    """
+    __slots__ = ('overall', 'groups')
+
+    def __init__(self):
+        self.overall = GroupAggregate()
+        self.groups = dict((dimension, {}) for dimension in group_dimensions)
+
+    def add(self, group_values, arr_delay, cancelled, sort=True):
+        """
+        Adds one flight to the overall aggregate and to one aggregate per dimension.
+        :param group_values: Raw value of the flight for each dimension, in group_dimensions order.
+        :param arr_delay: Arrival delay of the flight, None when missing.
+        :param cancelled: 1 when the flight was cancelled, 0 otherwise.
+        :param sort: Whether to keep the delays sorted, otherwise sort_delays() has to be called.
+        """
+        self.overall.add(arr_delay, cancelled, sort)
+        for dimension, value in zip(group_dimensions, group_values):
+            groups = self.groups[dimension]
+            aggregate = groups.get(value)
+            if aggregate is None:
+                # New groups are only published once they hold their first flight
+                aggregate = GroupAggregate()
+                aggregate.add(arr_delay, cancelled, sort)
+                groups[value] = aggregate
+            else:
+                aggregate.add(arr_delay, cancelled, sort)
+
+    def merge(self, other):
+        """
+        Adds the flights of the aggregates of another partition to these ones.
+        :param other: OriginAggregates to merge.
+        """
+        self.overall.merge(other.overall)
+        for dimension in group_dimensions:
+            groups = self.groups[dimension]
+            for value, other_aggregate in other.groups[dimension].items():
+                aggregate = groups.get(value)
+                if aggregate is None:
+                    aggregate = GroupAggregate()
+                    aggregate.merge(other_aggregate)
+                    groups[value] = aggregate
+                else:
+                    aggregate.merge(other_aggregate)
+
+    def sort_delays(self):
+        """
+        Sorts the delays of every aggregate added with sort=False.
+        """
+        self.overall.sort_delays()
+        for groups in self.groups.values():
+            for aggregate in groups.values():
+                aggregate.sort_delays()
+
+    def state(self, delays=None):
+        """
+        Returns the aggregates as plain lists, e.g. to be sent across processes.
+        :param delays: List the sorted delays of every aggregate are appended to.
+        :return: List of the overall state and of [value, state] pairs per dimension.
+        """
+        return [self.overall.state(delays)] + \
+            [[[value, aggregate.state(delays)] for value, aggregate in self.groups[dimension].items()]
+             for dimension in group_dimensions]
+
+    @classmethod
+    def from_state(cls, state, delays=None):
+        """
+        Rebuilds the aggregates from the lists returned by state().
+        :param state: List of the overall state and of [value, state] pairs per dimension.
+        :param delays: Iterator of the sorted delays, in the order they were appended by state().
+        :return: OriginAggregates.
+        """
+        origin = cls()
+        origin.overall = GroupAggregate.from_state(state[0], delays)
+        for dimension, groups in zip(group_dimensions, state[1:]):
+            origin.groups[dimension] = dict((value, GroupAggregate.from_state(aggregate_state, delays))
+                                            for value, aggregate_state in groups)
+        return origin
+
+
+class AggregateCube(object):
+    """
+    Aggregates of every origin airport, keyed by origin code.
+    """
+
+    def __init__(self, table=None):
+        self.origins = {}   # origin code -> OriginAggregates built in this process
+        self.table = table  # AggregateTable of the origins loaded from a snapshot, None when built from the flights
+
+    def add(self, origin_code, group_values, arr_delay, cancelled, sort=True):
+        """
+        Adds one flight to the aggregates of its origin.
+        :param origin_code: Encoded origin of the flight.
+        :param group_values: Raw value of the flight for each dimension, in group_dimensions order.
+        :param arr_delay: Arrival delay of the flight, None when missing.
+        :param cancelled: 1 when the flight was cancelled, 0 otherwise.
+        :param sort: Whether to keep the delays sorted, otherwise sort_delays() has to be called.
+        """
+        origin = self.origins.get(origin_code)
+        if origin is None:
+            # New origins, or origins copied out of the table, are only published once they hold the flight
+            table_origin = self.table.get(origin_code) if self.table is not None else None
+            origin = OriginAggregates() if table_origin is None else table_origin.copy()
+            origin.add(group_values, arr_delay, cancelled, sort)
+            self.origins[origin_code] = origin
+        else:
+            origin.add(group_values, arr_delay, cancelled, sort)
+
+    def merge(self, origin_code, other):
+        """
+        Adds the aggregates of an origin computed on another partition.
+        :param origin_code: Encoded origin of the flights.
+        :param other: OriginAggregates to merge.
+        """
+        origin = self.origins.get(origin_code)
+        if origin is None:
+            origin = OriginAggregates()
+            origin.merge(other)
+            self.origins[origin_code] = origin
+        else:
+            origin.merge(other)
+
+    def get(self, origin_code):
+        """
+        Returns the aggregates of an origin.
+        :param origin_code: Encoded origin airport.
+        :return: OriginAggregates or TableOrigin, None when the origin has no flights.
+        """
+        origin = self.origins.get(origin_code)
+        if origin is None and self.table is not None:
+            return self.table.get(origin_code)
+        return origin
+
+    def origin_codes(self):
+        """
+        Lists the origins having flights.
+        :return: Sorted list of origin codes.
+        """
+        origin_codes = set(self.origins)
+        if self.table is not None:
+            origin_codes.update(self.table.positions)
+        return sorted(origin_codes)
+
+    def sort_delays(self):
+        """
+        Sorts the delays of every origin added with sort=False.
+        """
+        for origin in self.origins.values():
+            origin.sort_delays()
+
+    def state(self, delays=None):
+        """
+        Returns the cube as plain lists, e.g. to be sent across processes.
+        :param delays: List the sorted delays of every aggregate are appended to.
+        :return: List of [origin code, origin state] pairs.
+        """
+        return [[origin_code, origin.state(delays)] for origin_code, origin in self.origins.items()]
+
+
+class TableAggregate(GroupAggregate):
+    """
+    Aggregate read from an AggregateTable, its delays viewed in the table.
+    Its sketch is only built when used.
+    """
+    __slots__ = ('table', 'index', 'table_sketch')
+
+    def __init__(self, table, index):
+        self.table = table
+        self.index = index
+        self.table_sketch = None
+        self.recent = None
+        self.count = table.counts[index]
+        self.cancelled = table.cancelled[index]
+        self.delay_count = table.delay_counts[index]
+        self.min_delay = table.min_delays[index] if self.delay_count else None
+        self.max_delay = table.max_delays[index] if self.delay_count else None
+        self.delays = table.delays[table.delay_offsets[index]:table.delay_offsets[index + 1]]
+
+    @property
+    def sketch(self):
+        if self.table_sketch is None:
+            self.table_sketch = self.table.sketch(self.index)
+        return self.table_sketch
+
+    def copy(self):
+        """
+        Copies the aggregate out of the table, so flights can be added to it.
+        :return: GroupAggregate.
+        """
+        aggregate = GroupAggregate(keep_delays=False, keep_sketch=False)
+        aggregate.count = self.count
+        aggregate.cancelled = self.cancelled
+        aggregate.delay_count = self.delay_count
+        aggregate.min_delay = self.min_delay
+        aggregate.max_delay = self.max_delay
+        aggregate.delays = array('i', self.delays)
+        aggregate.sketch = self.table.sketch(self.index)
+        return aggregate
+
+
+class TableGroups(object):
+    """
+    Read-only mapping of the values of one group dimension of an origin to their aggregates,
+    found by binary search in an AggregateTable.
+    """
+    __slots__ = ('table', 'start', 'stop')
+
+    def __init__(self, table, start, stop):
+        self.table = table
+        self.start = start
+        self.stop = stop
+
+    def __len__(self):
+        return self.stop - self.start
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __contains__(self, value):
+        return self.get(value) is not None
+
+    def __getitem__(self, value):
+        aggregate = self.get(value)
+        if aggregate is None:
+            raise KeyError(value)
+        return aggregate
+
+    def get(self, value, default=None):
+        group_values = self.table.group_values
+        position = bisect_left(group_values, value, self.start, self.stop)
+        if position < self.stop and group_values[position] == value:
+            return TableAggregate(self.table, self.table.group_aggregates[position])
+        return default
+
+    def keys(self):
+        return list(self.table.group_values[self.start:self.stop])
+
+    def values(self):
+        return [TableAggregate(self.table, index) for index in self.table.group_aggregates[self.start:self.stop]]
+
+    def items(self):
+        return list(zip(self.keys(), self.values()))
+
+
+class TableOrigin(object):
+    """
+    Aggregates of the flights flying from one origin airport, read from an AggregateTable.
+    """
+    __slots__ = ('overall', 'groups')
+
+    def __init__(self, table, position):
+        self.overall = TableAggregate(table, table.origin_aggregates[position])
+        first = position * len(group_dimensions)
+        self.groups = dict((dimension, TableGroups(table, table.group_offsets[first + offset],
+                                                   table.group_offsets[first + offset + 1]))
+                           for offset, dimension in enumerate(group_dimensions))
+
+    def copy(self):
+        """
+        Copies the aggregates out of the table, so flights can be added to them.
+        :return: OriginAggregates.
+        """
+        origin = OriginAggregates()
+        origin.overall = self.overall.copy()
+        for dimension, groups in self.groups.items():
+            origin.groups[dimension] = dict((value, aggregate.copy()) for value, aggregate in groups.items())
+        return origin
+
+
+class AggregateTable(object):
+    """
+    Aggregates of every origin airport laid out in flat arrays, one entry per aggregate :
+    counters, offsets of the sorted delays and of the sketch buckets.
+    The overall aggregate and the group values of every origin point to their entries,
+    group values are sorted within each origin and dimension.
+    """
+
+    def __init__(self, blocks):
+        """
+        :param blocks: Dictionary of the name of every table_fields -> array or memoryview of its values.
+        """
+        for name in table_fields:
+            values = blocks[name]
+            if isinstance(values, array):
+                try:
+                    values = memoryview(values)  # slices of the delays without copies
+                except TypeError:
+                    pass  # Python 2 arrays have no buffer interface
+            setattr(self, name, values)
+        self.positions = dict((origin_code, position) for position, origin_code in enumerate(self.origin_codes))
+
+    def get(self, origin_code):
+        """
+        Returns the aggregates of an origin.
+        :param origin_code: Encoded origin airport.
+        :return: TableOrigin, None when the origin is not in the table.
+        """
+        position = self.positions.get(origin_code)
+        if position is None:
+            return None
+        return TableOrigin(self, position)
+
+    def sketch(self, index):
+        """
+        Builds the sketch of an aggregate from its buckets.
+        :param index: Entry of the aggregate.
+        :return: DelaySketch.
+        """
+        start, middle, stop = self.sketch_offsets[2 * index:2 * index + 3]
+        sketch = DelaySketch()
+        sketch.zero_count = self.zero_counts[index]
+        sketch.positive = dict(zip(self.sketch_indexes[start:middle], self.sketch_counts[start:middle]))
+        sketch.negative = dict(zip(self.sketch_indexes[middle:stop], self.sketch_counts[middle:stop]))
+        sketch.count = sketch.zero_count + sum(self.sketch_counts[start:stop])
+        return sketch
+
+
+def table_blocks(cube):
+    """
+    Lays out the aggregates of a cube in the arrays of an AggregateTable, e.g. to write them to a snapshot.
+    :param cube: AggregateCube.
+    :return: Dictionary of the name of every table_fields -> array of its values.
+    """
+    blocks = dict((name, array('i')) for name in table_fields)
+    counts, cancelled, delay_counts = blocks['counts'], blocks['cancelled'], blocks['delay_counts']
+    min_delays, max_delays = blocks['min_delays'], blocks['max_delays']
+    delay_offsets, delays = blocks['delay_offsets'], blocks['delays']
+    zero_counts, sketch_offsets = blocks['zero_counts'], blocks['sketch_offsets']
+    sketch_indexes, sketch_counts = blocks['sketch_indexes'], blocks['sketch_counts']
+    delay_offsets.append(0)
+    sketch_offsets.append(0)
+    blocks['group_offsets'].append(0)
+
+    def add(aggregate):
+        counts.append(aggregate.count)
+        cancelled.append(aggregate.cancelled)
+        delay_counts.append(aggregate.delay_count)
+        min_delays.append(aggregate.min_delay if aggregate.delay_count else 0)
+        max_delays.append(aggregate.max_delay if aggregate.delay_count else 0)
+        delays.extend(aggregate.sorted_delays())
+        delay_offsets.append(len(delays))
+        sketch = aggregate.sketch
+        zero_counts.append(sketch.zero_count)
+        for buckets in (sketch.positive, sketch.negative):
+            for index in sorted(buckets):
+                sketch_indexes.append(index)
+                sketch_counts.append(buckets[index])
+            sketch_offsets.append(len(sketch_indexes))
+        return len(counts) - 1
+
+    for origin_code in cube.origin_codes():
+        origin = cube.get(origin_code)
+        blocks['origin_codes'].append(origin_code)
+        blocks['origin_aggregates'].append(add(origin.overall))
+        for dimension in group_dimensions:
+            groups = origin.groups[dimension]
+            for value in sorted(groups.keys()):
+                blocks['group_values'].append(value)
+                blocks['group_aggregates'].append(add(groups[value]))
+            blocks['group_offsets'].append(len(blocks['group_values']))
+    return blocks
+
+
+def aggregate_rows(store, rows, groupings, with_delays=False, with_sketch=False):
+    """
+    Aggregates flights by several groupings in a single pass over the rows.
+    Every flight is added to one aggregate of each grouping.
+    :param store: FlightStore holding the flights.
+    :param rows: Row ids of the flights to aggregate.
+    :param groupings: List of tuples of group dimensions, e.g. [('dest', 'unique_carrier')].
+    :param with_delays: Whether to keep the sorted delays of the aggregates.
+    :param with_sketch: Whether to keep the delay sketches of the aggregates.
+    :return: List of dictionaries of tuple of raw values -> GroupAggregate, one per grouping.
+    """
+    grouping_columns = [[store.columns[dimension] for dimension in grouping] for grouping in groupings]
+    results = [{} for grouping in groupings]
+    grouped = list(zip(grouping_columns, results))
+    arr_delay = store.arr_delay
+    cancelled = store.cancelled
+    missing_delay = store.missing_delay
+
+    for row in rows:
+        time_of_arrival = arr_delay[row]
+        if time_of_arrival == missing_delay:
+            time_of_arrival = None
+        row_cancelled = cancelled[row]
+
+        for columns, groups in grouped:
+            key = tuple([column[row] for column in columns])
+            aggregate = groups.get(key)
+            if aggregate is None:
+                aggregate = groups[key] = GroupAggregate(with_delays, with_sketch)
+            aggregate.add(time_of_arrival, row_cancelled, sort=False)
+
+    if with_delays:
+        for groups in results:
+            for aggregate in groups.values():
+                aggregate.sort_delays()
+    return results
+
+
+def combine_aggregates(aggregates, with_delays=False, with_sketch=False):
+    """
+    Returns one aggregate of several groups of flights, e.g. the distances of a range.
+    A single aggregate is returned as is, without copying its delays.
+    :param aggregates: List of GroupAggregate.
+    :param with_delays: Whether to keep the sorted delays of the combined aggregate.
+    :param with_sketch: Whether to keep the delay sketch of the combined aggregate.
+    :return: GroupAggregate.
+    """
+    if len(aggregates) == 1:
+        return aggregates[0]
+    combined = GroupAggregate(with_delays, with_sketch)
+    for aggregate in aggregates:
+        combined.merge(aggregate, sort=False)
+    combined.sort_delays()
+    return combined
+
+
+class DistanceBuckets(object):
+    """
+    Maps a distance to the label of its distance range in O(1).
+    Ranges are either every <width> miles, found by integer division,
+    or a list of named (name, lower, upper) ranges, found by bisect.
+    Labels are built once per range and cached.
+    """
+
+    def __init__(self, width=None, ranges=None):
+        if (width is None) == (ranges is None):
+            raise ValueError("DistanceBuckets needs either a width or ranges")
+        if width is not None and width <= 0:
+            raise ValueError("Distance range width must be positive")
+        self.width = width
+        self.ranges = sorted(ranges, key=lambda distance_range: distance_range[1]) if ranges else None
+        self.labels = {}
+
+        if self.ranges:
+            self.lower_edges = [lower for name, lower, upper in self.ranges]
+            for index, (name, lower, upper) in enumerate(self.ranges):
+                if upper is None:
+                    self.labels[index] = "%s (%d+ miles)" % (name, lower)
+                else:
+                    self.labels[index] = "%s (%d - %d miles)" % (name, lower, upper)
+
+    def key(self):
+        """
+        Returns a hashable description of the ranges, used to tell bucketings apart.
+        :return: Width of the ranges or tuple of named ranges.
+        """
+        return self.width if self.width is not None else tuple(self.ranges)
+
+    def label(self, distance):
+        """
+        Returns the label of the range a distance falls in.
+        :param distance: Distance in miles.
+        :return: Label of the range, None when no range holds the distance.
+        """
+        if self.width is not None:
+            index = distance // self.width
+            label = self.labels.get(index)
+            if label is None:
+                distance_limit = index * self.width
+                label = self.labels[index] = \
+                    str(distance_limit) + " - " + str(distance_limit + self.width) + " miles"
+            return label
+
+        index = bisect_right(self.lower_edges, distance) - 1
+        if index < 0:
+            return None
+        name, lower, upper = self.ranges[index]
+        if upper is not None and distance >= upper:
+            return None
+        return self.labels[index]
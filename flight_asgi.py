@@ -0,0 +1,218 @@
+#!flask/bin/python
+# Copyright (C) 2015 Edward Wijaya
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Asyncio serving mode of the Skyscanner On Time Flight Data REST API
+
+An ASGI application serving the routes of the Flask app, for clients
+that keep many mostly idle connections open :
+- connections are held by the event loop of the ASGI server, an idle
+  connection costs memory but no thread
+- every request is answered by the Flask app, so the routes and their
+  JSON output are the same
+- the Flask app is called in a bounded pool of ASGI_THREADS threads,
+  so aggregations never stall the event loop, requests beyond the pool
+  wait in its queue
+- GET / is read from the app chunk by chunk in the pool and streamed
+
+Needs Python 3 and an ASGI server, run with uvicorn :
+    python3 flight_asgi.py [--host 127.0.0.1] [--port 5000] [--threads 8]
+or with any other ASGI server, serving flight_asgi:application.
+
+"""
+
+import argparse
+import asyncio
+import io
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from skyscanner_rest_flight import app
+from skyscanner_rest_flight import start_watcher
+
+app.config.setdefault('ASGI_THREADS', 8)  # threads calling the Flask app, connections are not bound to them
+
+response_chunk_bytes = 64 * 1024  # bytes of a response read from the app before they are sent
+executor = ThreadPoolExecutor(app.config['ASGI_THREADS'])
+
+
+def wsgi_environ(scope, body):
+    """
+    Builds the WSGI environ of an ASGI HTTP request.
+    :param scope: ASGI scope of the request.
+    :param body: Body of the request, as bytes.
+    :return: Dictionary of the WSGI environ.
+    """
+    server_name, server_port = scope.get('server') or ('localhost', 80)
+    environ = {'REQUEST_METHOD': scope['method'],
+               'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+               'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+               'QUERY_STRING': scope['query_string'].decode('latin-1'),
+               'SERVER_NAME': server_name,
+               'SERVER_PORT': str(server_port),
+               'SERVER_PROTOCOL': 'HTTP/%s' % scope.get('http_version', '1.1'),
+               'CONTENT_LENGTH': str(len(body)),
+               'wsgi.version': (1, 0),
+               'wsgi.url_scheme': scope.get('scheme', 'http'),
+               'wsgi.input': io.BytesIO(body),
+               'wsgi.errors': sys.stderr,
+               'wsgi.multithread': True,
+               'wsgi.multiprocess': False,
+               'wsgi.run_once': False}
+    if scope.get('client'):
+        environ['REMOTE_ADDR'], environ['REMOTE_PORT'] = scope['client'][0], str(scope['client'][1])
+
+    for name, value in scope['headers']:
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name == 'CONTENT_LENGTH':
+            continue
+        if name != 'CONTENT_TYPE':
+            name = 'HTTP_' + name
+        environ[name] = environ[name] + ',' + value if name in environ else value
+    return environ
+
+
+class WSGIResponse(object):
+    """
+    Response of a call to the Flask app, read in the thread pool.
+    """
+
+    def __init__(self, environ):
+        self.environ = environ
+        self.status = None
+        self.headers = []
+        self.written = []   # chunks given to the legacy write callable
+        self.chunks = None
+
+    def start_response(self, status, headers, exc_info=None):
+        self.status = int(status.split(' ', 1)[0])
+        self.headers = [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers]
+        return self.written.append
+
+    def start(self):
+        """
+        Calls the Flask app, then reads the start of its response.
+        :return: Tuple of (chunk of the body, whether the body is complete).
+        """
+        self.chunks = app.wsgi_app(self.environ, self.start_response)
+        return self.read()
+
+    def read(self):
+        """
+        Reads the next chunks of the response, up to response_chunk_bytes.
+        :return: Tuple of (chunk of the body, whether the body is complete).
+        """
+        data = [b''.join(self.written)]
+        del self.written[:]
+        size = len(data[0])
+        for chunk in self.chunks:
+            data.append(chunk)
+            size += len(chunk)
+            if size >= response_chunk_bytes:
+                return b''.join(data), False
+        return b''.join(data), True
+
+    def close(self):
+        if hasattr(self.chunks, 'close'):
+            self.chunks.close()
+
+
+async def read_body(receive):
+    """
+    Reads the whole body of a request.
+    :param receive: ASGI receive callable.
+    :return: Body as bytes.
+    """
+    body = []
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            break
+        body.append(message.get('body', b''))
+        if not message.get('more_body'):
+            break
+    return b''.join(body)
+
+
+async def handle_http(scope, receive, send):
+    """
+    Answers an HTTP request with the Flask app called in the thread pool.
+    :param scope: ASGI scope of the request.
+    :param receive: ASGI receive callable.
+    :param send: ASGI send callable.
+    """
+    loop = asyncio.get_event_loop()
+    response = WSGIResponse(wsgi_environ(scope, await read_body(receive)))
+    try:
+        data, complete = await loop.run_in_executor(executor, response.start)
+        await send({'type': 'http.response.start', 'status': response.status, 'headers': response.headers})
+        while not complete:
+            await send({'type': 'http.response.body', 'body': data, 'more_body': True})
+            data, complete = await loop.run_in_executor(executor, response.read)
+        await send({'type': 'http.response.body', 'body': data})
+    finally:
+        await loop.run_in_executor(executor, response.close)
+
+
+async def handle_lifespan(receive, send):
+    """
+    Starts watching the flights data on startup, and stops the thread pool on shutdown.
+    :param receive: ASGI receive callable.
+    :param send: ASGI send callable.
+    """
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            start_watcher()
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            executor.shutdown(wait=False)
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def application(scope, receive, send):
+    """
+    ASGI entry point.
+    :param scope: ASGI scope of the connection.
+    :param receive: ASGI receive callable.
+    :param send: ASGI send callable.
+    """
+    if scope['type'] == 'http':
+        await handle_http(scope, receive, send)
+    elif scope['type'] == 'lifespan':
+        await handle_lifespan(receive, send)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Serve the flights REST API from an asyncio event loop")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--threads', type=int, default=None, help="threads calling the app, ASGI_THREADS by default")
+    arguments = parser.parse_args()
+    try:
+        import uvicorn
+    except ImportError:
+        parser.error("uvicorn is needed to serve the ASGI application, pip install uvicorn")
+    if arguments.threads:
+        executor = ThreadPoolExecutor(arguments.threads)
+    uvicorn.run(application, host=arguments.host, port=arguments.port, log_level='info')
@@ -0,0 +1,238 @@
+# Copyright (C) 2015 Edward Wijaya
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""NumPy engine for the group aggregations of the On Time Flight Data
+
+Computes the same GroupAggregate objects as aggregate_rows, with
+vectorized reductions over the typed columns instead of a loop over
+the flights :
+- the group of every flight is found from the values of its columns,
+  combined into one integer
+- counts come from np.bincount
+- minimum and maximum of the negative delays from np.minimum.at and
+  np.maximum.at
+- the sorted delays from one sort by group and delay, cut at the group
+  boundaries
+
+NumPy is optional, available tells whether it could be imported.
+
+"""
+
+from flight_aggregates import GroupAggregate
+from flight_sketch import DelaySketch
+from flight_sketch import bucket_index
+from flight_snapshot import array_from_bytes
+from flight_store import MISSING_DELAY
+from flight_store import column_typecode
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+available = numpy is not None
+dense_group_limit = 1 << 20  # combined group ranges numbered without sorting
+
+
+def gather_columns(store, rows, fields, lock=None):
+    """
+    Copies the values of some columns for a set of rows into NumPy arrays.
+    The columns are viewed in place, the lock keeps them from being
+    reallocated by an append while they are viewed. It is held for one
+    row by the writers, e.g. FlightStore.columns_lock.
+    :param store: FlightStore holding the flights.
+    :param rows: Array of row ids.
+    :param fields: Names of the columns to copy.
+    :param lock: Lock held by the writers of the store while they append a row, None when the store is not written to.
+    :return: Dictionary of field name -> NumPy array of the values of the rows.
+    """
+    if lock is not None:
+        lock.acquire()
+    try:
+        row_ids = numpy.frombuffer(rows, dtype=column_typecode(rows)).copy()
+        values = {}
+        for field in fields:
+            column = store.columns[field]
+            values[field] = numpy.frombuffer(column, dtype=column_typecode(column))[row_ids]
+        return values
+    finally:
+        if lock is not None:
+            lock.release()
+
+
+def group_ids(values, grouping):
+    """
+    Numbers the groups of the flights by the values of some columns.
+    Values are offset into a dense range and combined into one integer,
+    groups are then numbered with np.bincount, or with np.unique when
+    the combined range is too large.
+    :param values: Dictionary of field name -> NumPy array of values.
+    :param grouping: Tuple of group dimensions.
+    :return: Tuple of (group id of every flight, list of tuples of raw values per group id).
+    """
+    combined = numpy.zeros(len(values[grouping[0]]), dtype=numpy.int64)
+    ranges = []
+    for dimension in grouping:
+        column = values[dimension]
+        lowest = int(column.min())
+        size = int(column.max()) - lowest + 1
+        combined = combined * size + (column.astype(numpy.int64) - lowest)
+        ranges.append((lowest, size))
+
+    total = 1
+    for lowest, size in ranges:
+        total *= size
+    if total <= max(dense_group_limit, 2 * len(combined)):
+        present = numpy.bincount(combined, minlength=total) > 0
+        codes = numpy.flatnonzero(present)
+        ids = (numpy.cumsum(present) - 1)[combined]
+    else:
+        codes, ids = numpy.unique(combined, return_inverse=True)
+        ids = ids.reshape(-1)
+
+    keys = []
+    for code in codes.tolist():
+        key = []
+        for lowest, size in reversed(ranges):
+            code, index = divmod(code, size)
+            key.append(lowest + index)
+        keys.append(tuple(reversed(key)))
+    return ids, keys
+
+
+def segment_bounds(sorted_ids, groups):
+    """
+    Returns where every group starts and ends in an array sorted by group id.
+    :param sorted_ids: Sorted NumPy array of group ids.
+    :param groups: Number of groups.
+    :return: Tuple of (NumPy array of starts, NumPy array of ends).
+    """
+    group_range = numpy.arange(groups)
+    return numpy.searchsorted(sorted_ids, group_range, 'left'), numpy.searchsorted(sorted_ids, group_range, 'right')
+
+
+def delay_sketches(ids, minutes, groups):
+    """
+    Builds the DelaySketch of every group.
+    Bucket indexes are computed once per distinct value, the same way as DelaySketch.add.
+    :param ids: NumPy array of the group id of the flights with an arrival delay.
+    :param minutes: NumPy array of their minutes late.
+    :param groups: Number of groups.
+    :return: List of DelaySketch, one per group id.
+    """
+    sketches = [DelaySketch() for group in range(groups)]
+    if not len(minutes):
+        return sketches
+    signs = numpy.sign(minutes)
+    magnitudes, inverse = numpy.unique(numpy.abs(minutes), return_inverse=True)
+    indexes = numpy.array([bucket_index(magnitude) if magnitude else 0 for magnitude in magnitudes.tolist()],
+                          dtype=numpy.int64)[inverse.reshape(-1)]
+
+    # Count the flights of every (group, sign, bucket), sorted by group then sign
+    bucket_range = int(indexes.max()) + 1 if len(indexes) else 1
+    buckets = (ids.astype(numpy.int64) * 3 + (signs + 1)) * bucket_range + indexes
+    unique_buckets, counts = numpy.unique(buckets, return_counts=True)
+    group_signs = unique_buckets // bucket_range
+    bounds = numpy.flatnonzero(numpy.diff(group_signs)) + 1
+    starts = [0] + bounds.tolist()
+    ends = bounds.tolist() + [len(unique_buckets)]
+    index_list = (unique_buckets % bucket_range).tolist()
+    count_list = counts.tolist()
+
+    for start, end, group_sign in zip(starts, ends, group_signs[starts].tolist()):
+        group, sign = divmod(group_sign, 3)
+        sketch = sketches[group]
+        if sign == 2:
+            sketch.positive = dict(zip(index_list[start:end], count_list[start:end]))
+        elif sign == 0:
+            sketch.negative = dict(zip(index_list[start:end], count_list[start:end]))
+        else:
+            sketch.zero_count = count_list[start]
+        sketch.count += sum(count_list[start:end])
+    return sketches
+
+
+def aggregate_rows(store, rows, groupings, with_delays=False, with_sketch=False, lock=None):
+    """
+    Aggregates flights by several groupings, as flight_aggregates.aggregate_rows does.
+    :param store: FlightStore holding the flights.
+    :param rows: Array of row ids of the flights to aggregate.
+    :param groupings: List of tuples of group dimensions, e.g. [('dest', 'unique_carrier')].
+    :param with_delays: Whether to keep the sorted delays of the aggregates.
+    :param with_sketch: Whether to keep the delay sketches of the aggregates.
+    :param lock: Lock held by the writers of the store while they append a row, None when the store is not written to.
+    :return: List of dictionaries of tuple of raw values -> GroupAggregate, one per grouping.
+    """
+    if not len(rows):
+        return [{} for grouping in groupings]
+
+    dimensions = set(dimension for grouping in groupings for dimension in grouping)
+    values = gather_columns(store, rows, sorted(dimensions | {'arr_delay', 'cancelled'}), lock)
+    arr_delay = values['arr_delay']
+    with_delay = arr_delay != MISSING_DELAY
+    late = with_delay & (arr_delay < 0)
+
+    results = []
+    for grouping in groupings:
+        ids, keys = group_ids(values, grouping)
+        groups = len(keys)
+        counts = numpy.bincount(ids, minlength=groups).tolist()
+        cancelled = numpy.bincount(ids[values['cancelled'] == 1], minlength=groups).tolist()
+        delay_counts = numpy.bincount(ids[late], minlength=groups).tolist()
+
+        # Extremes of the negative delays, groups without any keep the initial values
+        late_ids = ids[late]
+        late_delays = arr_delay[late]
+        min_delays = numpy.zeros(groups, dtype=arr_delay.dtype)
+        max_delays = numpy.full(groups, MISSING_DELAY, dtype=arr_delay.dtype)
+        numpy.minimum.at(min_delays, late_ids, late_delays)
+        numpy.maximum.at(max_delays, late_ids, late_delays)
+        min_delays = min_delays.tolist()
+        max_delays = max_delays.tolist()
+
+        if with_delays or with_sketch:
+            delay_ids = ids[with_delay]
+            minutes = -arr_delay[with_delay].astype(numpy.int64)
+        if with_delays:
+            order = numpy.lexsort((minutes, delay_ids))
+            delay_starts, delay_ends = segment_bounds(delay_ids[order], groups)
+            sorted_minutes = minutes[order].astype(numpy.dtype('i'))
+        sketches = delay_sketches(delay_ids, minutes, groups) if with_sketch else None
+
+        aggregates = {}
+        for group, key in enumerate(keys):
+            aggregate = GroupAggregate(keep_delays=False, keep_sketch=False)
+            aggregate.count = counts[group]
+            aggregate.cancelled = cancelled[group]
+            aggregate.delay_count = delay_counts[group]
+            if aggregate.delay_count:
+                aggregate.min_delay = min_delays[group]
+                aggregate.max_delay = max_delays[group]
+            if with_delays:
+                aggregate.delays = array_from_bytes('i', sorted_minutes[delay_starts[group]:delay_ends[group]]
+                                                    .tobytes())
+            if with_sketch:
+                aggregate.sketch = sketches[group]
+            aggregates[key] = aggregate
+        results.append(aggregates)
+
+    return results
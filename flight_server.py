@@ -0,0 +1,291 @@
+#!flask/bin/python
+# Copyright (C) 2015 Edward Wijaya
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Multi-worker server for the Skyscanner On Time Flight Data REST API
+
+The master process loads and indexes the flights data once, opens the
+listening socket and then forks the workers, which all accept requests
+on that socket. The workers share the pages of the dataset with the
+master: the columns are arrays whose data is never written, and the
+heap is frozen before forking (gc.freeze, Python 3.7+) so the garbage
+collector does not touch the objects loaded by the master. Reading an
+object still writes its reference count though, so the pages of the
+aggregates built by the master are copied into every worker answering
+requests about them. With FLIGHTS_MAP_SNAPSHOT the aggregates are read
+from the mapped snapshot file like the columns, and the private memory
+of a worker no longer grows with the number of flights: it holds the
+string dictionaries and the objects of the requests in progress.
+
+Every worker holds a copy-on-write view of the dataset, so the endpoints
+that change it (POST / and POST /admin/reload) are disabled here.
+Workers that die are replaced, SIGTERM or SIGINT stops them all.
+A worker stops gracefully: it stops accepting connections, then exits
+once its requests in progress are answered, or after
+WORKER_STOP_SECONDS.
+
+SIGHUP reloads the flights data in the master, as does a change of the
+data files every FLIGHTS_WATCH_INTERVAL seconds. With FLIGHTS_MAP_SNAPSHOT
+the master publishes a new snapshot file and every worker switches to it
+on its own, between two requests. Otherwise the workers are replaced by
+workers forked from the reloaded master, one at a time: a new worker is
+started, then one worker holding the previous data is stopped, and the
+next one once it has exited.
+
+Run with :
+    ./flight_server.py [--host 127.0.0.1] [--port 5000] [--workers <number of cores>]
+
+"""
+
+import argparse
+import errno
+import gc
+import os
+import signal
+import time
+from multiprocessing import cpu_count
+from threading import Condition
+from threading import Thread
+from werkzeug.serving import make_server
+import skyscanner_rest_flight
+from skyscanner_rest_flight import app
+
+app.config.setdefault('WORKER_STOP_SECONDS', 30)  # seconds a stopping worker waits for its requests in progress
+
+poll_interval = 0.5  # seconds between two checks of the workers by the master
+
+
+def freeze_heap():
+    """
+    Collects the garbage and moves every object left to a permanent generation,
+    so the collector never writes to the pages shared with the workers.
+    """
+    gc.collect()
+    if hasattr(gc, 'freeze'):
+        gc.freeze()
+
+
+class ActiveRequests(object):
+    """
+    Counts the requests a worker is answering in threads, so it can wait for them before exiting.
+    """
+
+    def __init__(self, server):
+        """
+        :param server: WSGI server, a server answering in its serving loop has nothing to count.
+        """
+        self.count = 0
+        self.condition = Condition()
+        if hasattr(server, 'process_request_thread'):
+            self.track(server)
+
+    def track(self, server):
+        """
+        Wraps the methods of a threaded server that start and answer a request.
+        :param server: WSGI server answering every request in its own thread.
+        """
+        process_request = server.process_request
+        process_request_thread = server.process_request_thread
+
+        def counted_process_request(request, client_address):
+            # Counted by the serving loop, before the thread answering the request starts
+            with self.condition:
+                self.count += 1
+            try:
+                process_request(request, client_address)
+            except BaseException:
+                self.done()
+                raise
+
+        def counted_process_request_thread(request, client_address):
+            try:
+                process_request_thread(request, client_address)
+            finally:
+                self.done()
+
+        server.process_request = counted_process_request
+        server.process_request_thread = counted_process_request_thread
+
+    def done(self):
+        """
+        Counts a request as answered.
+        """
+        with self.condition:
+            self.count -= 1
+            self.condition.notify_all()
+
+    def wait(self, timeout):
+        """
+        Waits until no request is being answered.
+        :param timeout: Seconds to wait at most.
+        :return: True when every request was answered.
+        """
+        deadline = time.time() + timeout
+        with self.condition:
+            while self.count and time.time() < deadline:
+                self.condition.wait(deadline - time.time())
+            return not self.count
+
+
+def spawn_worker(server):
+    """
+    Forks a worker serving requests on the listening socket of the master.
+    SIGTERM stops it gracefully, SIGINT is left to the master.
+    :param server: WSGI server bound to the listening socket.
+    :return: Process id of the worker.
+    """
+    pid = os.fork()
+    if pid:
+        return pid
+
+    active_requests = ActiveRequests(server)
+
+    def stop(signum, frame):
+        # The serving loop runs in this thread, it can only be shut down from another one
+        thread = Thread(target=server.shutdown, name='worker-stop')
+        thread.daemon = True
+        thread.start()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    if app.config['FLIGHTS_MAP_SNAPSHOT']:
+        # Only the master rebuilds the data, workers follow the snapshot it publishes
+        skyscanner_rest_flight.start_watcher(app.config['FLIGHTS_WATCH_INTERVAL'] or 1, watch_data=False)
+    try:
+        server.serve_forever()
+        if not active_requests.wait(app.config['WORKER_STOP_SECONDS']):
+            app.logger.warning("Worker %d stopped with %d requests in progress", os.getpid(), active_requests.count)
+    finally:
+        os._exit(0)
+
+
+def reload_data():
+    """
+    Reloads the flights data in the master.
+    :return: True when the workers have to be replaced by workers holding the new data,
+             workers of a mapped snapshot switch to the new one by themselves.
+    """
+    if not skyscanner_rest_flight.reload_lock.acquire(False):
+        return False
+    version = skyscanner_rest_flight.flight_store.version
+    skyscanner_rest_flight.reload_flights()
+    if skyscanner_rest_flight.flight_store.version == version:
+        return False  # failed, already logged
+    freeze_heap()
+    return not app.config['FLIGHTS_MAP_SNAPSHOT']
+
+
+def serve(host='127.0.0.1', port=5000, workers=None, threaded=True):
+    """
+    Serves the REST API from several worker processes until SIGTERM or SIGINT.
+    :param host: Interface to listen on.
+    :param port: Port to listen on.
+    :param workers: Number of worker processes, one per core when None.
+    :param threaded: Whether every worker answers its requests in threads.
+    """
+    workers = workers or cpu_count()
+    app.config['ADMIN_TOKEN'] = None  # the workers cannot change the shared dataset
+    server = make_server(host, port, app, threaded=threaded)
+    # Every worker is woken by a new connection, the ones not getting it must not
+    # stay blocked in accept, they would never see that they are stopped
+    server.socket.settimeout(poll_interval)
+    freeze_heap()
+
+    children = set()
+    stale = set()       # workers holding the data before a reload, replaced one at a time
+    retiring = set()    # worker stopped to be replaced, at most one
+    stopping = []
+    reloading = []
+
+    def stop(signum, frame):
+        stopping.append(signum)
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+    def reload(signum, frame):
+        reloading.append(signum)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGHUP, reload)
+    app.logger.info("Serving on http://%s:%d with %d workers", host, port, workers)
+
+    watch_interval = app.config['FLIGHTS_WATCH_INTERVAL']
+    last_stamp = skyscanner_rest_flight.flights_data_stamp() if watch_interval > 0 else None
+    next_check = time.time() + watch_interval
+    while True:
+        if stale and not retiring and not stopping:
+            pid = stale.pop()
+            try:
+                os.kill(pid, signal.SIGTERM)
+                retiring.add(pid)
+            except OSError:
+                pass
+        # A worker being replaced does not count, its replacement starts right away
+        while not stopping and len(children) - len(retiring) < workers:
+            children.add(spawn_worker(server))
+        if not children:
+            break
+
+        if watch_interval > 0 and time.time() >= next_check:
+            next_check = time.time() + watch_interval
+            stamp = skyscanner_rest_flight.flights_data_stamp()
+            if stamp is not None and stamp != last_stamp:
+                last_stamp = stamp
+                reloading.append('watch')
+        if reloading and not stopping:
+            del reloading[:]
+            if reload_data():
+                stale.update(children - retiring)
+
+        try:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+        except OSError as error:
+            if error.errno == errno.EINTR:
+                continue
+            if error.errno == errno.ECHILD:
+                break
+            raise
+        if not pid:
+            time.sleep(poll_interval)
+            continue
+        children.discard(pid)
+        stale.discard(pid)
+        if pid in retiring:
+            retiring.discard(pid)
+        elif not stopping:
+            app.logger.warning("Worker %d exited with status %d, starting another one", pid, status)
+
+    server.server_close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Serve the flights REST API from several processes")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--workers', type=int, default=None, help="number of worker processes, one per core by default")
+    arguments = parser.parse_args()
+    serve(arguments.host, arguments.port, arguments.workers)
@@ -0,0 +1,149 @@
+# Copyright (C) 2015 Edward Wijaya
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Mergeable quantile sketch of arrival delays
+
+A DelaySketch counts values in buckets whose bounds grow geometrically,
+as in DDSketch : bucket i holds the values in (gamma^(i-1), gamma^i]
+with gamma = (1 + relative_accuracy) / (1 - relative_accuracy).
+Any quantile is then estimated within relative_accuracy of its value.
+
+Positive and negative values are counted apart, zeros on their own.
+Minutes fit in a few hundred buckets whatever the number of flights,
+and two sketches are merged by adding their bucket counts, so sketches
+of different groups or partitions can be combined.
+
+"""
+
+import math
+
+relative_accuracy = 0.01
+gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+log_gamma = math.log(gamma)
+bucket_indexes = {}  # absolute value -> bucket index, values are whole minutes
+
+
+def bucket_index(value):
+    """
+    Returns the bucket of a positive value.
+    :param value: Positive value.
+    :return: Index of the bucket.
+    """
+    index = bucket_indexes.get(value)
+    if index is None:
+        index = bucket_indexes[value] = int(math.ceil(math.log(value) / log_gamma))
+    return index
+
+
+def bucket_value(index):
+    """
+    Returns the value standing for a bucket, at equal relative distance from its bounds.
+    :param index: Index of the bucket.
+    :return: Value of the bucket.
+    """
+    return 2 * gamma ** index / (gamma + 1)
+
+
+class DelaySketch(object):
+    """
+    Quantile sketch of arrival delays with a relative accuracy of relative_accuracy.
+    """
+    __slots__ = ('count', 'zero_count', 'positive', 'negative')
+
+    def __init__(self):
+        self.count = 0
+        self.zero_count = 0
+        self.positive = {}  # bucket index -> count of positive values
+        self.negative = {}  # bucket index -> count of negative values, by absolute value
+
+    def add(self, value):
+        """
+        Counts one value.
+        :param value: Value to count, e.g. minutes late.
+        """
+        if value > 0:
+            index = bucket_index(value)
+            self.positive[index] = self.positive.get(index, 0) + 1
+        elif value < 0:
+            index = bucket_index(-value)
+            self.negative[index] = self.negative.get(index, 0) + 1
+        else:
+            self.zero_count += 1
+        self.count += 1
+
+    def merge(self, other):
+        """
+        Counts the values of another sketch.
+        :param other: DelaySketch to merge.
+        """
+        for buckets, other_buckets in ((self.positive, other.positive), (self.negative, other.negative)):
+            for index, count in list(other_buckets.items()):  # other may be counting values meanwhile
+                buckets[index] = buckets.get(index, 0) + count
+        self.zero_count += other.zero_count
+        self.count += other.count
+
+    def quantile(self, quantile):
+        """
+        Estimates a quantile of the values.
+        :param quantile: Quantile between 0 and 1.
+        :return: Estimated value, None when the sketch is empty.
+        """
+        if self.count == 0:
+            return None
+        rank = quantile * (self.count - 1)
+
+        seen = 0
+        for index in sorted(self.negative, reverse=True):
+            seen += self.negative[index]
+            if seen > rank:
+                return -bucket_value(index)
+        seen += self.zero_count
+        if seen > rank:
+            return 0
+        for index in sorted(self.positive):
+            seen += self.positive[index]
+            if seen > rank:
+                return bucket_value(index)
+        return bucket_value(max(self.positive)) if self.positive else 0
+
+    def state(self):
+        """
+        Returns the sketch as plain lists, e.g. to be sent across processes.
+        :return: List of the zero count, and of [index, count] pairs of positive and negative values.
+        """
+        return [self.zero_count,
+                [[index, count] for index, count in self.positive.items()],
+                [[index, count] for index, count in self.negative.items()]]
+
+    @classmethod
+    def from_state(cls, state):
+        """
+        Rebuilds a sketch from the lists returned by state().
+        :param state: List of the zero count, and of [index, count] pairs of positive and negative values.
+        :return: DelaySketch.
+        """
+        sketch = cls()
+        sketch.zero_count = state[0]
+        sketch.positive = dict((index, count) for index, count in state[1])
+        sketch.negative = dict((index, count) for index, count in state[2])
+        sketch.count = sketch.zero_count + sum(sketch.positive.values()) + sum(sketch.negative.values())
+        return sketch
@@ -0,0 +1,397 @@
+#!flask/bin/python
+# Copyright (C) 2015 Edward Wijaya
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Binary snapshot of a FlightStore for a fast cold start
+
+A snapshot file is laid out as :
+- the magic bytes FLTSNAP1
+- the length of the header, as an 8 bytes unsigned integer
+- the header, in JSON : source file stamp, write-ahead log sequence, size
+  of the ingest segment held, fields,
+  listing fields, string dictionaries, the source values GET / lists
+  apart from the columns and the position of every array in the file
+- the columns, the origin index and the arrays of the AggregateTable of
+  the aggregates (counters, sorted delays, sketch buckets), as raw
+  arrays aligned on 8 bytes
+
+Loading a snapshot reads the arrays as they are, no aggregate is rebuilt.
+
+The source stamp holds the mtime, size and SHA-1 of the JSON file the
+snapshot was built from, or of every JSON file of a dataset split across
+a directory or a glob pattern. A snapshot is only used when the JSON
+files are unchanged, otherwise the server falls back to loading them.
+
+A snapshot can also be loaded mapped: the arrays stay in the read-only
+mapping of the file, shared by every process that maps it. A new
+snapshot is published by renaming it over the previous one (replacing
+it, on Windows too), processes still mapping the previous file keep
+reading it until they switch.
+
+Convert a JSON data file, a directory or a glob pattern of JSON files with :
+    ./flight_snapshot.py data/ontime_data_test.json [data/ontime_data_test.snapshot] [listing,fields]
+
+"""
+
+import hashlib
+import json
+import mmap
+import os
+import struct
+import sys
+from array import array
+from flight_aggregates import AggregateCube
+from flight_aggregates import AggregateTable
+from flight_aggregates import table_blocks
+from flight_store import FlightStore
+from flight_store import StringDictionary
+from flight_store import column_typecode
+from flight_store import data_files
+from flight_store import is_glob
+
+snapshot_magic = b'FLTSNAP1'
+header_size_format = '<Q'
+column_alignment = 8
+
+
+def snapshot_path(source_path):
+    """
+    Returns the default snapshot path of a JSON data file.
+    :param source_path: Path of the JSON data file, of a directory or a glob pattern.
+    :return: Path of the snapshot, next to the JSON data file or directory.
+    """
+    if is_glob(source_path):
+        return os.path.join(os.path.dirname(source_path), 'flights.snapshot')
+    return os.path.splitext(source_path.rstrip('/\\'))[0] + '.snapshot'
+
+
+def file_digest(path):
+    """
+    Returns the SHA-1 of a file, read in chunks.
+    :param path: Path of the file.
+    :return: Hexadecimal digest.
+    """
+    digest = hashlib.sha1()
+    with open(path, 'rb') as source:
+        chunk = source.read(1024 * 1024)
+        while chunk:
+            digest.update(chunk)
+            chunk = source.read(1024 * 1024)
+    return digest.hexdigest()
+
+
+def file_stamp(path, with_digest=True):
+    """
+    Returns what identifies the content of a file.
+    :param path: Path of the file.
+    :param with_digest: Whether to hash the file content too.
+    :return: Dictionary of mtime, size and sha1.
+    """
+    stat = os.stat(path)
+    return {'mtime': stat.st_mtime,
+            'size': stat.st_size,
+            'sha1': file_digest(path) if with_digest else None}
+
+
+def source_stamp(source_path, with_digest=True):
+    """
+    Returns what identifies the content of the JSON data files.
+    :param source_path: Path of the JSON data file, of a directory or a glob pattern.
+    :param with_digest: Whether to hash the files content too.
+    :return: Stamp of the file, or dictionary of the stamps of every file.
+    """
+    paths = data_files(source_path)
+    if paths == [source_path]:
+        return file_stamp(source_path, with_digest)
+    return {'files': [[path, file_stamp(path, with_digest)] for path in paths]}
+
+
+def is_file_current(path, stamp):
+    """
+    Checks a file against its stamp, the file is only hashed when its mtime or size changed.
+    :param path: Path of the file.
+    :param stamp: Stamp of the file when the snapshot was written.
+    :return: True when the content of the file is unchanged.
+    """
+    current = file_stamp(path, with_digest=False)
+    if current['mtime'] == stamp['mtime'] and current['size'] == stamp['size']:
+        return True
+    return current['size'] == stamp['size'] and file_digest(path) == stamp['sha1']
+
+
+def stat_identity(stat):
+    """
+    Returns what identifies a snapshot file, which changes whenever a new one is published.
+    :param stat: Result of os.stat or os.fstat of the file.
+    :return: List of device, inode, mtime and size.
+    """
+    return [stat.st_dev, stat.st_ino, stat.st_mtime, stat.st_size]
+
+
+def snapshot_identity(path):
+    """
+    Returns the identity of the snapshot file at a path.
+    :param path: Path of the snapshot file.
+    :return: Identity as returned by stat_identity, None when there is no file.
+    """
+    try:
+        return stat_identity(os.stat(path))
+    except OSError:
+        return None
+
+
+def replace_file(source, destination):
+    """
+    Renames a file over another one, atomically where the platform allows it.
+    os.rename does not replace an existing file on Windows, Python 2 has no os.replace.
+    :param source: Path of the new file.
+    :param destination: Path of the file to replace.
+    """
+    if hasattr(os, 'replace'):
+        os.replace(source, destination)
+    elif os.name == 'nt' and os.path.exists(destination):
+        os.remove(destination)
+        os.rename(source, destination)
+    else:
+        os.rename(source, destination)
+
+
+def array_bytes(values):
+    return values.tobytes() if hasattr(values, 'tobytes') else values.tostring()
+
+
+def array_from_bytes(typecode, data):
+    values = array(typecode)
+    if hasattr(values, 'frombytes'):
+        values.frombytes(data)
+    else:
+        values.fromstring(data)
+    return values
+
+
+def write_snapshot(store, path, stamp=None):
+    """
+    Writes a store to a snapshot file, replacing it atomically.
+    :param store: FlightStore to write.
+    :param path: Path of the snapshot file.
+    :param stamp: Source stamp of the JSON data file, the one of the store by default.
+    """
+    # Origin index written as one array of row ids sorted by origin
+    origin_codes = sorted(store.origin_index)
+    origin_offsets = []
+    origin_rows = array('i')
+    for origin_code in origin_codes:
+        origin_offsets.append([origin_code, len(origin_rows), len(store.origin_index[origin_code])])
+        origin_rows.extend(store.origin_index[origin_code])
+
+    aggregates = table_blocks(store.cube)
+
+    blocks = [(field, store.columns[field]) for field in sorted(store.columns)]
+    extra_blocks = [('origin_rows', origin_rows)]
+    aggregate_blocks = [(name, aggregates[name]) for name in sorted(aggregates)]
+
+    header = {'source': stamp if stamp is not None else store.source_stamp,
+              'wal_sequence': store.wal_sequence,
+              'ingest_offset': store.ingest_offset,
+              'byteorder': sys.byteorder,
+              'itemsizes': dict((typecode, array(typecode).itemsize) for typecode in 'bi'),
+              'rows': len(store),
+              'fields': store.fields,
+              'listing_fields': None if store.listing_fields is None else sorted(store.listing_fields),
+              'dictionaries': dict((field, dictionary.values) for field, dictionary in store.dictionaries.items()),
+              'listing_values': dict((field, sorted(values.items())) for field, values in store.listing_values.items()),
+              'listed_from': store.listed_from,
+              'origin_index': origin_offsets,
+              'columns': [],
+              'aggregates': {}}
+
+    # Column offsets are relative to the end of the header
+    offset = 0
+    layout = []
+    all_blocks = blocks + extra_blocks + aggregate_blocks
+    for field, values in all_blocks:
+        layout.append({'typecode': column_typecode(values), 'offset': offset, 'length': len(values)})
+        offset += len(values) * values.itemsize
+        offset += -offset % column_alignment
+    for (field, values), block in zip(blocks, layout):
+        block['field'] = field
+        header['columns'].append(block)
+    for (name, values), block in zip(extra_blocks, layout[len(blocks):]):
+        header[name] = block
+    for (name, values), block in zip(aggregate_blocks, layout[len(blocks) + len(extra_blocks):]):
+        header['aggregates'][name] = block
+
+    header_bytes = json.dumps(header).encode('utf-8')
+    header_bytes += b' ' * (-(len(snapshot_magic) + 8 + len(header_bytes)) % column_alignment)
+
+    # Unique per process, independent servers may publish the same snapshot
+    temp_path = '%s.%d.tmp' % (path, os.getpid())
+    with open(temp_path, 'wb') as snapshot:
+        snapshot.write(snapshot_magic)
+        snapshot.write(struct.pack(header_size_format, len(header_bytes)))
+        snapshot.write(header_bytes)
+        for field, values in all_blocks:
+            data = array_bytes(values)
+            snapshot.write(data)
+            snapshot.write(b'\0' * (-len(data) % column_alignment))
+        snapshot.flush()
+        os.fsync(snapshot.fileno())
+    replace_file(temp_path, path)
+
+
+def read_header(snapshot_map):
+    """
+    Reads the header of a mapped snapshot file.
+    :param snapshot_map: mmap of the snapshot file.
+    :return: Tuple of (header dictionary, offset of the first column), None when not a snapshot.
+    """
+    magic_size = len(snapshot_magic)
+    if snapshot_map[:magic_size] != snapshot_magic:
+        return None
+    header_size = struct.unpack(header_size_format, snapshot_map[magic_size:magic_size + 8])[0]
+    data_offset = magic_size + 8 + header_size
+    header = json.loads(snapshot_map[magic_size + 8:data_offset].decode('utf-8'))
+    return header, data_offset
+
+
+def is_current(header, source_path):
+    """
+    Checks that a snapshot was built from the current content of its JSON data files.
+    :param header: Header of the snapshot.
+    :param source_path: Path of the JSON data file, of a directory or a glob pattern.
+    :return: True when the snapshot can be used instead of the JSON data file.
+    """
+    if header.get('byteorder') != sys.byteorder:
+        return False
+    if any(array(str(typecode)).itemsize != itemsize for typecode, itemsize in header.get('itemsizes', {}).items()):
+        return False
+
+    # Without its JSON data files, the snapshot is all there is to load
+    stamp = header.get('source')
+    paths = [] if source_path is None else [path for path in data_files(source_path) if os.path.exists(path)]
+    if not paths:
+        return True
+    if stamp is None:
+        return False
+
+    if 'files' not in stamp:
+        return paths == [source_path] and is_file_current(source_path, stamp)
+    return [path for path, path_stamp in stamp['files']] == paths and \
+        all(is_file_current(path, path_stamp) for path, path_stamp in stamp['files'])
+
+
+def load_snapshot(path, source_path=None, listing_fields=None, mapped=False):
+    """
+    Loads a store from a snapshot file through mmap.
+    A mapped store views its columns, origin index and aggregates in place in the
+    read-only mapping, so every process mapping the same file shares one copy
+    of them in the page cache. The mapping lives as long as the store.
+    Views need memoryview.cast, Python 2 copies the arrays instead.
+    :param path: Path of the snapshot file.
+    :param source_path: Path of the JSON data file the snapshot should match.
+    :param listing_fields: Other fields kept for GET / the snapshot should match, every field when None.
+    :param mapped: Whether to view the arrays in the mapping instead of copying them.
+    :return: FlightStore, None when there is no usable snapshot.
+    """
+    if not os.path.exists(path):
+        return None
+
+    with open(path, 'rb') as snapshot:
+        identity = stat_identity(os.fstat(snapshot.fileno()))
+        snapshot_map = mmap.mmap(snapshot.fileno(), 0, access=mmap.ACCESS_READ)
+    mapped = mapped and hasattr(memoryview, 'cast')
+    try:
+        parsed = read_header(snapshot_map)
+        if parsed is None:
+            return None
+        header, data_offset = parsed
+        if not is_current(header, source_path):
+            return None
+        if header.get('listing_fields') != (None if listing_fields is None else sorted(listing_fields)):
+            return None
+        if 'aggregates' not in header:
+            return None  # written before the aggregates were laid out in arrays
+        if 'listing_values' not in header:
+            return None  # written before the source values were kept for GET /
+
+        snapshot_view = memoryview(snapshot_map) if mapped else None
+
+        def read_block(block):
+            typecode = str(block['typecode'])
+            start = data_offset + block['offset']
+            size = block['length'] * array(typecode).itemsize
+            if mapped:
+                return snapshot_view[start:start + size].cast(typecode)
+            return array_from_bytes(typecode, snapshot_map[start:start + size])
+
+        store = FlightStore(listing_fields)
+        store.fields = header['fields']
+        store.fields_set = set(store.fields)
+        store.seen_fields = set(store.fields)
+        for field, values in header['dictionaries'].items():
+            dictionary = store.dictionaries[field] = StringDictionary()
+            dictionary.values = values
+            dictionary.codes = dict((value, code) for code, value in enumerate(values))
+        for field, values in header['listing_values'].items():
+            store.listing_values[field] = dict((row, text) for row, text in values)
+        store.listed_from = header['listed_from']
+        for block in header['columns']:
+            store.columns[block['field']] = read_block(block)
+        store.bind_columns()
+        store.rows = header['rows']
+
+        origin_rows = read_block(header['origin_rows'])
+        for origin_code, start, length in header['origin_index']:
+            store.origin_index[origin_code] = origin_rows[start:start + length]
+        store.cube = AggregateCube(AggregateTable(dict((name, read_block(block))
+                                                       for name, block in header['aggregates'].items())))
+        store.source_stamp = header['source']
+        store.wal_sequence = header.get('wal_sequence', 0)
+        store.ingest_offset = header.get('ingest_offset', 0)
+        store.snapshot_file = identity
+        store.mapped = mapped
+        return store
+    finally:
+        if not mapped:
+            snapshot_map.close()
+
+
+def convert(source_path, path=None, listing_fields=None):
+    """
+    Builds the snapshot of a JSON data file, or of the JSON files of a directory or a glob pattern.
+    :param source_path: Path of the JSON data file, of a directory or a glob pattern.
+    :param path: Path of the snapshot file, next to the JSON data file by default.
+    :param listing_fields: Other fields to keep for GET /, every field when None.
+    :return: Path of the snapshot file.
+    """
+    path = path or snapshot_path(source_path)
+    stamp = source_stamp(source_path)
+    write_snapshot(FlightStore.from_json_files(data_files(source_path), listing_fields), path, stamp)
+    return path
+
+
+if __name__ == '__main__':
+    if len(sys.argv) not in (2, 3, 4):
+        sys.exit("Usage: %s <flights JSON file> [snapshot file] [listing fields]" % sys.argv[0])
+    listing_fields = sys.argv[3].split(',') if len(sys.argv) == 4 else None
+    print("Snapshot written to " + convert(sys.argv[1], sys.argv[2] if len(sys.argv) > 2 else None,
+                                           listing_fields))
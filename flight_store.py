@@ -0,0 +1,804 @@
+# Copyright (C) 2015 Edward Wijaya
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Columnar in-memory store for the On Time Flight Data
+
+Every flight is kept as one row across a set of columns :
+- arr_delay, cancelled, distance, day_of_week as typed arrays
+- origin, dest, unique_carrier as dictionary-encoded arrays of codes
+- any other field of the source file as a dictionary-encoded column,
+  only kept for GET / and dropped when not listed in listing_fields
+
+Values are coerced once by flight_schema when the flights are loaded,
+so the endpoints never have to convert strings to numbers while serving
+a request. A flight without arrival delay gets MISSING_DELAY.
+GET / lists the flights as the source records held them: the values the
+columns do not hold as they were (e.g. a number instead of a numeric
+string, a code in lower case) and the fields a flight lacks are recorded
+apart in listing_values, so they are listed as received or left out.
+An origin index maps every origin code to the row ids of its flights.
+Airport and carrier codes are normalized once when they are stored, so
+lookups by code are case-insensitive.
+The aggregates of every origin are kept up to date as flights are added,
+so new flights can be appended while the store is being read: the length
+of the store only counts a row once all of its columns hold it. Every
+appended batch bumps the revision of the store.
+
+JSON data files are parsed incrementally, one flight record at a time,
+so loading never holds the whole parsed document in memory.
+
+A dataset can be split across several JSON files, e.g. one per month,
+given as a directory or a glob pattern. Every file is loaded into its
+own partition by a pool of processes, then the partitions are merged
+in file order: dictionary codes are remapped to the codes of the merged
+store, row ids are shifted and the aggregates are merged. The pool is
+only used when processes are started by forking, a spawned process would
+import the module loading the data again, so files are otherwise loaded
+one after the other.
+
+A store loaded from a mapped snapshot reads its columns, origin index
+and aggregates in place from the snapshot file. The columns and origin
+index are copied into arrays of the process with make_writable before
+the first append, the aggregates of an origin when a flight is added to it.
+
+"""
+
+import glob
+import io
+import json
+import multiprocessing
+import os
+import re
+from array import array
+from bisect import bisect_left
+from itertools import count
+from json.scanner import py_make_scanner
+from multiprocessing import Pool
+from multiprocessing import cpu_count
+from threading import Lock
+from flight_aggregates import AggregateCube
+from flight_aggregates import OriginAggregates
+from flight_aggregates import writable_array
+
+MISSING_DELAY = -2147483648  # arr_delay value of flights without a recorded delay
+
+
+def coerce_int(value):
+    """
+    Converts a JSON value to an integer, missing values become 0.
+    :param value: String or number from the source file.
+    :return: Integer value.
+    """
+    if value is None or value == '':
+        return 0
+    try:
+        return int(value)
+    except ValueError:
+        return int(float(value))  # e.g. "2475.00"
+
+
+def coerce_delay(value):
+    """
+    Converts a JSON arrival delay to an integer, missing values become MISSING_DELAY.
+    :param value: String or number from the source file.
+    :return: Integer delay in minutes.
+    """
+    if value is None or value == '':
+        return MISSING_DELAY
+    return coerce_int(value)
+
+
+def coerce_flag(value):
+    """
+    Converts a JSON flag to 1 or 0, missing values become 0.
+    :param value: String, number or boolean from the source file.
+    :return: 1 when the flag is set, 0 otherwise.
+    """
+    if value in (True, 'true', 'True'):
+        return 1
+    if value in (False, 'false', 'False'):
+        return 0
+    return 1 if coerce_int(value) else 0
+
+
+# Typed columns : field -> (array typecode, coercion of the source value)
+flight_schema = {'arr_delay': ('i', coerce_delay),
+                 'cancelled': ('b', coerce_flag),
+                 'distance': ('i', coerce_int),
+                 'day_of_week': ('b', coerce_int)}
+numeric_fields = dict((field, typecode) for field, (typecode, coerce) in flight_schema.items())
+encoded_fields = ('origin', 'dest', 'unique_carrier')
+store_versions = count(1)  # every store built gets the next dataset version
+json_chunk_size = 1024 * 1024  # characters read at once from a JSON data file
+json_token_margin = 16  # characters before the end of a chunk a value cut short can fail to decode at
+json_whitespace = re.compile(r'[ \t\r\n]*')
+json_separator = re.compile(r'[ \t\r\n]*,')
+json_error_position = re.compile(r'\(char (\d+)')
+json_python_decoder = json.JSONDecoder()
+json_python_decoder.scan_once = py_make_scanner(json_python_decoder)
+
+
+def canonical_code(code):
+    """
+    Returns the normalized form of an airport or carrier code.
+    :param code: Airport or carrier code as received.
+    :return: Code stripped and in upper case.
+    """
+    return code.strip().upper()
+
+
+def column_typecode(values):
+    """
+    Returns the typecode of a column.
+    :param values: array, or memoryview mapped from a snapshot.
+    :return: Typecode of the values, e.g. 'i'.
+    """
+    return values.typecode if isinstance(values, array) else values.format
+
+
+def is_glob(data_path):
+    """
+    Tells whether a data path is a glob pattern.
+    :param data_path: Path of the flights data.
+    :return: True when the path holds wildcards.
+    """
+    return glob.has_magic(data_path)
+
+
+def data_files(data_path):
+    """
+    Lists the JSON files of a dataset.
+    :param data_path: Path of a JSON file, of a directory of JSON files or a glob pattern.
+    :return: Sorted list of the paths of the JSON files.
+    """
+    if os.path.isdir(data_path):
+        return sorted(glob.glob(os.path.join(data_path, '*.json')))
+    if is_glob(data_path):
+        return sorted(path for path in glob.glob(data_path) if os.path.isfile(path))
+    return [data_path]
+
+
+def is_truncated(error, buffer, position):
+    """
+    Tells whether a JSON decoding error may come from the end of the buffer cutting a value short,
+    rather than from a syntax error.
+    :param error: ValueError raised by the decoder.
+    :param buffer: Text being decoded.
+    :param position: Position the value was decoded from.
+    :return: True when reading more of the file may complete the value.
+    """
+    message = str(error)
+    error_position = getattr(error, 'pos', None)
+    if error_position is None and not json_error_position.search(message):
+        # The C scanner of Python 2 does not locate errors in nested values, its Python scanner does
+        try:
+            json_python_decoder.raw_decode(buffer, position)
+        except ValueError as python_error:
+            message = str(python_error)
+    if message.startswith('Unterminated string') or message == 'end is out of bounds':
+        return True  # the string goes on past the buffer
+    if error_position is None:
+        match = json_error_position.search(message)  # Python 2 only gives it in the message
+        error_position = int(match.group(1)) if match else position
+    return error_position >= len(buffer) - json_token_margin
+
+
+def iter_json_array(source, chunk_size=json_chunk_size):
+    """
+    Parses the items of a JSON array one by one while reading the file in chunks.
+    Items must be separated by commas, and only whitespace may follow the array.
+    Raises ValueError as soon as the data is found not to be a JSON array.
+    :param source: File object holding a JSON array.
+    :param chunk_size: Number of characters read at once.
+    :return: Generator of the parsed items.
+    """
+    decoder = json.JSONDecoder()
+    buffer = source.read(chunk_size)
+    position = 0
+    end_of_file = not buffer
+    expected = '['  # '[' before the array, 'item' or ']' after '[', ',' or ']' after an item, 'item' after ','
+
+    while True:
+        position = json_whitespace.match(buffer, position).end()
+
+        if position < len(buffer):
+            char = buffer[position]
+            if expected == '[':
+                if char != '[':
+                    raise ValueError("JSON data is not an array")
+                position += 1
+                expected = 'item or ]'
+                continue
+            if char == ']' and expected != 'item':
+                # Only whitespace may follow the array
+                rest = buffer[position + 1:]
+                while rest:
+                    if json_whitespace.match(rest).end() < len(rest):
+                        raise ValueError("Extra data after the JSON array")
+                    rest = source.read(chunk_size)
+                return
+            if expected == ',':
+                if char != ',':
+                    raise ValueError("Expecting ',' between the items of the JSON array")
+                position += 1
+                expected = 'item'
+                continue
+            try:
+                item, end = decoder.raw_decode(buffer, position)
+            except ValueError as error:
+                if end_of_file or not is_truncated(error, buffer, position):
+                    raise
+            else:
+                # A number ending with the buffer may go on in the next chunk
+                if end < len(buffer) or end_of_file:
+                    separator = json_separator.match(buffer, end)
+                    if separator is None:
+                        position = end
+                        expected = ','
+                    else:
+                        position = separator.end()
+                        expected = 'item'
+                    yield item
+                    continue
+        elif end_of_file:
+            raise ValueError("JSON data is not an array" if expected == '[' else "JSON array is not terminated")
+
+        # The next item is incomplete, read another chunk
+        chunk = source.read(chunk_size)
+        end_of_file = not chunk
+        buffer = buffer[position:] + chunk
+        position = 0
+
+
+def is_valid_record(record):
+    """
+    Checks that every field of a flight record is a JSON scalar (string, number, boolean or null),
+    and that the typed fields can be coerced and stored.
+    :param record: Dictionary of flight fields.
+    :return: True when the record can be appended to a store.
+    """
+    for value in record.values():
+        if isinstance(value, (list, dict)):
+            return False  # cannot be dictionary-encoded
+    try:
+        for field, (typecode, coerce) in flight_schema.items():
+            array(typecode, [coerce(record.get(field))])
+        for field in encoded_fields:
+            canonical_code(record.get(field) or '')
+    except (ValueError, TypeError, OverflowError, AttributeError):
+        return False
+    return True
+
+
+def is_valid_batch(records):
+    """
+    Checks that a batch of flights is a non-empty list of records that can all be appended to a store,
+    each with an origin.
+    :param records: Batch of flights as parsed from JSON.
+    :return: True when the whole batch can be appended.
+    """
+    if not isinstance(records, list) or not records:
+        return False
+    for record in records:
+        if not isinstance(record, dict) or not record.get('origin') or not is_valid_record(record):
+            return False
+    return True
+
+
+def forks_processes():
+    """
+    Tells whether multiprocessing starts its processes by forking the current one.
+    :return: True with the fork start method.
+    """
+    if not hasattr(multiprocessing, 'get_start_method'):
+        return os.name != 'nt'  # Python 2 forks but on Windows
+    # Without fixing the start method, the first one listed is the default
+    method = multiprocessing.get_start_method(allow_none=True) or multiprocessing.get_all_start_methods()[0]
+    return method == 'fork'
+
+
+def load_partition(arguments):
+    """
+    Loads one JSON file of a dataset, run by the processes of the loading pool.
+    :param arguments: Tuple of (path of the JSON file, listing fields).
+    :return: Partition of the file, as returned by FlightStore.partition().
+    """
+    path, listing_fields = arguments
+    return FlightStore.from_json_file(path, listing_fields).partition()
+
+
+class StringDictionary(object):
+    """
+    Maps every distinct string of a column to a small integer code.
+    """
+
+    def __init__(self):
+        self.values = []
+        self.codes = {}
+        self.json_values = {}  # code -> value serialized as a JSON string, filled on demand
+
+    def __len__(self):
+        return len(self.values)
+
+    def encode(self, value):
+        """
+        Returns the code of a value, adding the value when it is new.
+        :param value: String value to encode.
+        :return: Integer code of the value.
+        """
+        code = self.codes.get(value)
+        if code is None:
+            code = len(self.values)
+            self.values.append(value)
+            self.codes[value] = code
+        return code
+
+    def decode(self, code):
+        """
+        Returns the string value of a code.
+        :param code: Integer code to decode.
+        :return: String value of the code.
+        """
+        return self.values[code]
+
+    def json_value(self, code):
+        """
+        Returns the value of a code serialized as a JSON string.
+        :param code: Integer code to serialize.
+        :return: JSON representation of the value.
+        """
+        json_value = self.json_values.get(code)
+        if json_value is None:
+            json_value = self.json_values[code] = json.dumps(self.values[code])
+        return json_value
+
+
+class FlightStore(object):
+    """
+    Flights data stored column by column.
+    """
+    missing_delay = MISSING_DELAY
+
+    def __init__(self, listing_fields=None):
+        self.version = next(store_versions)
+        self.rows = 0       # number of flights, only counts a row once all its columns hold it
+        self.revision = 0   # number of batches appended since the store was built
+        self.wal_sequence = 0   # sequence of the last write-ahead log batch held
+        self.ingest_offset = 0  # size of the start of the ingest segment whose batches are held
+        self.source_stamp = None    # stamp of the JSON data file the store was built from
+        self.snapshot_file = None   # identity of the snapshot file the store was loaded from
+        self.mapped = False     # whether the columns are read-only views of the snapshot file
+        self.identity = None    # ((wal_sequence, revision), content identity) last computed
+        self.listing_fields = None if listing_fields is None else frozenset(listing_fields)
+        self.fields = []    # field names kept, in the order of the source records
+        self.fields_set = set()
+        self.seen_fields = set()    # field names kept or dropped
+        self.columns = {}   # field name -> array of values or codes
+        self.dictionaries = {}  # field name -> StringDictionary of encoded columns
+        self.listing_values = {}    # field name -> {row id: JSON text of the source value, None when lacking}
+        self.listed_from = {}   # field name -> first row of a field first seen after some flights
+
+        for field, typecode in numeric_fields.items():
+            self.columns[field] = array(typecode)
+        for field in encoded_fields:
+            self.columns[field] = array('i')
+            self.dictionaries[field] = StringDictionary()
+
+        self.origin_index = {}  # origin code -> array of row ids
+        self.cube = AggregateCube()
+        self.columns_lock = Lock()  # held while a row is appended to the columns, or while they are viewed in place
+        self.bind_columns()
+
+    def bind_columns(self):
+        """
+        Points the shortcut attributes to the numeric columns,
+        to be called again whenever the columns are replaced.
+        """
+        self.arr_delay = self.columns['arr_delay']
+        self.cancelled = self.columns['cancelled']
+        self.distance = self.columns['distance']
+        self.day_of_week = self.columns['day_of_week']
+
+    def __len__(self):
+        return self.rows
+
+    def make_writable(self):
+        """
+        Copies the columns and origin index viewed from a mapped snapshot
+        into arrays of this process, so flights can be appended.
+        Readers still holding the views keep reading the same values.
+        """
+        if not self.mapped:
+            return
+        for field in list(self.columns):
+            self.columns[field] = writable_array(self.columns[field])
+        self.bind_columns()
+        for origin_code in list(self.origin_index):
+            self.origin_index[origin_code] = writable_array(self.origin_index[origin_code])
+        self.mapped = False
+
+    def view(self, rows, fields):
+        """
+        Returns the first rows of the store as another store, e.g. to write them to a snapshot
+        while flights are being appended. Rows are only appended, so the columns and the origin
+        index are sliced up to the row count without holding off appends. The aggregates of the
+        origins flights were added to are built again from their rows, the others are shared.
+        :param rows: Number of rows, read while appends were held off.
+        :param fields: Field names kept, read along with the number of rows.
+        :return: FlightStore holding the first rows.
+        """
+        store = FlightStore(self.listing_fields)
+        store.rows = rows
+        store.source_stamp = self.source_stamp
+        store.snapshot_file = self.snapshot_file
+        store.fields = list(fields)
+        store.fields_set = set(fields)
+        store.seen_fields = set(self.seen_fields)
+        store.listed_from = dict(self.listed_from)
+        for field, values in list(self.listing_values.items()):
+            store.listing_values[field] = dict((row, text) for row, text in list(values.items()) if row < rows)
+        for field in store.fields_set.union(numeric_fields, encoded_fields):
+            store.columns[field] = self.columns[field][:rows]
+            dictionary = self.dictionaries.get(field)
+            if dictionary is not None:
+                view_dictionary = store.dictionaries[field] = StringDictionary()
+                view_dictionary.values = list(dictionary.values)
+                view_dictionary.codes = dict((value, code) for code, value in enumerate(view_dictionary.values))
+        store.bind_columns()
+
+        for origin_code, origin_rows in list(self.origin_index.items()):
+            origin_rows = origin_rows[:bisect_left(origin_rows, rows)]
+            if len(origin_rows):
+                store.origin_index[origin_code] = origin_rows
+
+        # Origins never added to are still the ones read from the snapshot table
+        for origin_code in list(self.cube.origins):
+            for row in store.origin_index.get(origin_code, ()):
+                store.add_aggregates(row, sort=False)
+        store.cube.sort_delays()
+        store.cube.table = self.cube.table
+        return store
+
+    @classmethod
+    def from_records(cls, records, listing_fields=None):
+        """
+        Builds a store from a list of flights records.
+        :param records: Iterable of flights as parsed from the JSON data.
+        :param listing_fields: Other fields to keep for GET /, every field when None.
+        :return: FlightStore holding every flight.
+        """
+        store = cls(listing_fields)
+        for record in records:
+            store.append(record, sort=False)
+        store.cube.sort_delays()
+        return store
+
+    @classmethod
+    def from_json_file(cls, path, listing_fields=None):
+        """
+        Builds a store from a JSON file holding a list of flights.
+        Flights are parsed and stored one at a time.
+        :param path: Path of the JSON data file.
+        :param listing_fields: Other fields to keep for GET /, every field when None.
+        :return: FlightStore holding every flight.
+        """
+        with io.open(path, encoding='utf-8') as json_data:
+            return cls.from_records(iter_json_array(json_data), listing_fields)
+
+    @classmethod
+    def from_json_files(cls, paths, listing_fields=None, processes=None):
+        """
+        Builds a store from several JSON files, loaded in parallel and merged in order.
+        Files are loaded one after the other when processes are not started by forking.
+        :param paths: Paths of the JSON data files.
+        :param listing_fields: Other fields to keep for GET /, every field when None.
+        :param processes: Number of loading processes, one per core when None.
+        :return: FlightStore holding every flight.
+        """
+        if not paths:
+            raise ValueError("No flights data file to load")
+        processes = min(processes or cpu_count(), len(paths)) if forks_processes() else 1
+        if processes <= 1:
+            store = cls.from_json_file(paths[0], listing_fields)
+            for path in paths[1:]:
+                store.merge(cls.from_json_file(path, listing_fields).partition())
+            return store
+
+        store = cls(listing_fields)
+        pool = Pool(processes)
+        try:
+            for partition in pool.imap(load_partition, [(path, listing_fields) for path in paths]):
+                store.merge(partition)
+            pool.close()
+        except BaseException:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+        return store
+
+    def partition(self):
+        """
+        Returns the content of the store as plain data, to be sent across processes.
+        :return: Dictionary of fields, columns, dictionary values, listing values, origin index and aggregates.
+        """
+        cube_delays = []
+        return {'fields': self.fields,
+                'seen_fields': sorted(self.seen_fields),
+                'columns': self.columns,
+                'dictionaries': dict((field, dictionary.values) for field, dictionary in self.dictionaries.items()),
+                'listing_values': self.listing_values,
+                'listed_from': self.listed_from,
+                'origin_index': self.origin_index,
+                'cube': self.cube.state(cube_delays),
+                'cube_delays': cube_delays}
+
+    def merge(self, partition):
+        """
+        Appends the flights of a partition loaded separately.
+        Codes of the partition are remapped to the codes of this store,
+        its row ids are shifted after the rows of this store.
+        :param partition: Partition as returned by partition().
+        """
+        for field in partition['fields'] + partition['seen_fields']:
+            if field not in self.seen_fields:
+                self._add_field(field)
+
+        offset = len(self)
+        rows = len(partition['columns']['arr_delay'])
+        columns = partition['columns']
+        for field in numeric_fields:
+            self.columns[field].extend(columns[field])
+
+        remaps = {}
+        for field, dictionary in self.dictionaries.items():
+            values = partition['dictionaries'].get(field)
+            if values is None:
+                self.columns[field].extend(array('i', [dictionary.encode('')]) * rows)
+                continue
+            remap = remaps[field] = array('i', [dictionary.encode(value) for value in values])
+            self.columns[field].extend(array('i', map(remap.__getitem__, columns[field])))
+
+        # Leading rows of the partition lacking a field are left out of GET /, as its own lacking values
+        lacking = [(field, rows) for field in self.dictionaries if field not in partition['dictionaries']]
+        lacking.extend(partition['listed_from'].items())
+        for field, lacking_rows in lacking:
+            if field in self.fields_set:
+                self.listing_values.setdefault(field, {}).update(dict.fromkeys(range(offset, offset + lacking_rows)))
+        for field, values in partition['listing_values'].items():
+            if field in self.fields_set:
+                self.listing_values.setdefault(field, {}).update((row + offset, text) for row, text in values.items())
+        self.rows = offset + rows
+
+        origin_remap = remaps['origin']
+        for origin_code, origin_rows in partition['origin_index'].items():
+            merged_code = origin_remap[origin_code]
+            shifted = array('i', [row + offset for row in origin_rows])
+            if merged_code in self.origin_index:
+                self.origin_index[merged_code].extend(shifted)
+            else:
+                self.origin_index[merged_code] = shifted
+
+        # Group values of dest and unique_carrier are codes too
+        cube_delays = iter(partition['cube_delays'])
+        for origin_code, origin_state in partition['cube']:
+            origin = OriginAggregates.from_state(origin_state, cube_delays)
+            for dimension in ('dest', 'unique_carrier'):
+                remap = remaps[dimension]
+                origin.groups[dimension] = dict((remap[value], aggregate)
+                                                for value, aggregate in origin.groups[dimension].items())
+            self.cube.merge(origin_remap[origin_code], origin)
+
+    def _add_field(self, field):
+        self.seen_fields.add(field)
+        if field not in self.columns and self.listing_fields is not None and field not in self.listing_fields:
+            return  # not used by any endpoint
+        if field not in self.columns:
+            # Any other field is kept dictionary-encoded for GET /,
+            # rows loaded before the field was seen get an empty value
+            dictionary = StringDictionary()
+            self.columns[field] = array('i', [dictionary.encode('')]) * len(self)
+            self.dictionaries[field] = dictionary
+        # Listed once its column exists, for the readers of GET /
+        if len(self):
+            self.listed_from[field] = len(self)
+        self.fields.append(field)
+        self.fields_set.add(field)
+
+    def append(self, record, sort=True):
+        """
+        Parses a flight record and appends it as a new row.
+        :param record: Dictionary of flight fields with string values.
+        :param sort: Whether to keep the delays of the aggregates sorted,
+                     otherwise cube.sort_delays() has to be called.
+        :return: Row id of the new flight.
+        """
+        if not self.seen_fields.issuperset(record):
+            for field in record:
+                if field not in self.seen_fields:
+                    self._add_field(field)
+
+        # The whole row is built before any column is appended to, so a
+        # record that cannot be stored leaves the columns aligned
+        row = len(self)
+        columns = self.columns
+        fields_set = self.fields_set
+        values = []
+        listed = []     # (field, JSON text of the source value, None when the flight lacks the field)
+        for field, (typecode, coerce) in flight_schema.items():
+            value = record.get(field)
+            stored = coerce(value)
+            values.append((columns[field], stored))
+            if field not in record:
+                if field in fields_set:
+                    listed.append((field, None))
+            elif value != ('' if stored == MISSING_DELAY else '%d' % stored):
+                listed.append((field, json.dumps(value)))
+
+        for field, dictionary in self.dictionaries.items():
+            if field not in record:
+                if field in fields_set:
+                    listed.append((field, None))
+                value = ''
+            else:
+                value = record[field]
+                if field in encoded_fields:
+                    stored = canonical_code(value or '')
+                    if stored != value:
+                        listed.append((field, json.dumps(value)))
+                    value = stored
+            values.append((columns[field], dictionary.encode(value)))
+
+        appended = []
+        with self.columns_lock:
+            try:
+                for column, value in values:
+                    column.append(value)
+                    appended.append(column)
+            except (OverflowError, TypeError):
+                for column in appended:
+                    column.pop()
+                raise
+            for field, text in listed:
+                listing_values = self.listing_values.get(field)
+                if listing_values is None:
+                    listing_values = self.listing_values[field] = {}
+                listing_values[row] = text
+            # Readers only see the row once every column holds it
+            self.rows = row + 1
+
+            origin_code = self.columns['origin'][row]
+            origin_rows = self.origin_index.get(origin_code)
+            if origin_rows is None:
+                origin_rows = self.origin_index[origin_code] = array('i')
+            origin_rows.append(row)
+
+        self.add_aggregates(row, sort)
+        return row
+
+    def add_aggregates(self, row, sort=True):
+        """
+        Adds a row of the columns to the aggregates of its origin.
+        :param row: Row id of the flight.
+        :param sort: Whether to keep the delays of the aggregates sorted,
+                     otherwise cube.sort_delays() has to be called.
+        """
+        columns = self.columns
+        arr_delay = self.arr_delay[row]
+        self.cube.add(columns['origin'][row],
+                      (columns['dest'][row], columns['unique_carrier'][row],
+                       self.day_of_week[row], self.distance[row]),
+                      None if arr_delay == MISSING_DELAY else arr_delay,
+                      self.cancelled[row], sort)
+
+    def origin_code(self, origin):
+        """
+        Returns the code of an origin airport.
+        :param origin: Origin airport code, in any case.
+        :return: Encoded origin, None when the origin is unknown.
+        """
+        return self.dictionaries['origin'].codes.get(canonical_code(origin))
+
+    def origin_aggregates(self, origin):
+        """
+        Returns the precomputed aggregates of an origin airport.
+        :param origin: Origin airport code, in any case.
+        :return: OriginAggregates, None when the origin is unknown.
+        """
+        return self.cube.get(self.origin_code(origin))
+
+    def origin_rows(self, origin):
+        """
+        Returns the row ids of the flights flying from an origin airport.
+        :param origin: Origin airport code, in any case.
+        :return: Array of row ids, empty when the origin is unknown.
+        """
+        origin_code = self.origin_code(origin)
+        if origin_code is None:
+            return array('i')
+        return self.origin_index[origin_code]
+
+    def append_batch(self, records):
+        """
+        Appends a batch of flight records and bumps the revision of the store.
+        The callers serialize appends, reads can go on meanwhile.
+        :param records: List of dictionaries of flight fields.
+        :return: Number of flights appended.
+        """
+        self.make_writable()
+        for record in records:
+            self.append(record)
+        self.revision += 1
+        return len(records)
+
+    def data_version(self):
+        """
+        Returns what identifies the current content of the store in this process.
+        :return: Tuple of (version, revision).
+        """
+        return self.version, self.revision
+
+    def content_identity(self):
+        """
+        Returns what identifies the content of the store across processes and restarts,
+        unlike data_version whose versions are numbered per process.
+        :return: JSON string of the source stamp, snapshot file identity, write-ahead log sequence and revision.
+        """
+        key = (self.wal_sequence, self.revision)
+        identity = self.identity
+        if identity is None or identity[0] != key:
+            identity = self.identity = (key, json.dumps([self.source_stamp, self.snapshot_file,
+                                                         self.wal_sequence, self.revision], sort_keys=True))
+        return identity[1]
+
+    def iter_json(self, rows, fields=None):
+        """
+        Serializes flights to JSON objects straight from the columns, with sorted keys.
+        Only the columns of the requested fields are read, values recorded in listing_values
+        are written as received and the fields a flight lacks are left out.
+        :param rows: Iterable of row ids of the flights.
+        :param fields: Names of the fields to write, all fields when None.
+        :return: Generator of one JSON object string per flight.
+        """
+        fields_columns = []
+        for field in sorted(self.fields if fields is None else fields):
+            fields_columns.append((json.dumps(field) + ': ', self.columns[field], self.dictionaries.get(field),
+                                   self.listing_values.get(field), self.listed_from.get(field, 0)))
+
+        for row in rows:
+            members = []
+            for key, column, dictionary, listing_values, listed_from in fields_columns:
+                if row < listed_from:
+                    continue
+                if listing_values and row in listing_values:
+                    text = listing_values[row]
+                    if text is not None:
+                        members.append(key + text)
+                    continue
+                value = column[row]
+                if dictionary is not None:
+                    members.append(key + dictionary.json_value(value))
+                elif value == MISSING_DELAY:
+                    members.append(key + '""')
+                else:
+                    members.append(key + '"%d"' % value)
+            yield '{' + ', '.join(members) + '}'
@@ -0,0 +1,271 @@
+# Copyright (C) 2015 Edward Wijaya
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Write-ahead log of the flights added at runtime
+
+Every batch of flights is checked to be storable, then written to the
+log and synced to disk, before it is added to the store. An entry of
+the log is laid out as :
+- the magic bytes FWAL
+- the sequence number of the batch, as an 8 bytes unsigned integer
+- the length of the payload, as a 4 bytes unsigned integer
+- the CRC-32 of the payload, as a 4 bytes unsigned integer
+- the payload, the batch of flights in JSON
+
+Snapshots record the sequence of the last batch they hold. On startup
+the snapshot is loaded and only the entries after that sequence are
+replayed. Snapshots also record the size of the ingest segment they
+hold the batches of, the segment is only read past that size, so
+recovery reads the tail of the segment rather than all of it. A torn entry at the end of the log, left by a crash while
+writing it, is dropped. An entry that cannot be added to the store is
+moved to the <log>.rejected file, in the same layout, and skipped.
+
+The file of the log is only created when the first batch is written.
+The ingest segment, holding every batch compacted out of the log, is a
+log of the same layout.
+
+"""
+
+import json
+import os
+import struct
+import zlib
+from threading import Lock
+from flight_snapshot import replace_file
+from flight_store import is_valid_batch
+
+entry_magic = b'FWAL'
+entry_header = struct.Struct('<4sQII')
+
+
+def write_entry(log, sequence, payload):
+    """
+    Writes an entry to a log file.
+    :param log: File opened for writing in binary mode.
+    :param sequence: Sequence number of the batch.
+    :param payload: Batch of flights in JSON, as bytes.
+    """
+    log.write(entry_header.pack(entry_magic, sequence, len(payload), zlib.crc32(payload) & 0xffffffff))
+    log.write(payload)
+
+
+def sync_file(log):
+    """
+    Flushes a file and syncs it to disk.
+    :param log: File opened for writing.
+    """
+    log.flush()
+    os.fsync(log.fileno())
+
+
+class WriteAheadLog(object):
+    """
+    Append-only, checksummed log of the batches of flights added to the store.
+    """
+
+    def __init__(self, path, offset=0, sequence=0):
+        """
+        :param path: Path of the log file.
+        :param offset: Size of the start of the log known to hold valid batches, e.g. the batches held by
+                       a snapshot, the log is only read past it.
+        :param sequence: Sequence of the last batch held before the offset.
+        """
+        self.path = path
+        self.sequence = sequence    # sequence of the last batch in the log
+        self.pending = 0    # number of batches in the log, past the offset
+        self.size = 0       # size of the valid entries of the log
+        self.lock = Lock()
+        self.log = None     # opened on the first append
+
+        # Find the last valid entry, and drop whatever follows it
+        valid_size = self._entries_offset(offset)
+        for sequence, payload, end in self._read_entries(valid_size):
+            self.sequence = max(self.sequence, sequence)
+            self.pending += 1
+            valid_size = end
+        self.size = valid_size
+        if os.path.exists(path) and os.path.getsize(path) > valid_size:
+            with open(path, 'r+b') as log:
+                log.truncate(valid_size)
+
+    def _entries_offset(self, offset):
+        # An offset only holds while it is the end of the log or the start of a valid entry,
+        # the log is read from its start otherwise, e.g. once it was rewritten
+        if not offset or not os.path.exists(self.path):
+            return 0
+        with open(self.path, 'rb') as log:
+            size = os.fstat(log.fileno()).st_size
+            if offset == size:
+                return offset
+            if offset > size:
+                return 0
+            log.seek(offset)
+            return offset if self._read_entry(log) is not None else 0
+
+    def _read_entry(self, log):
+        header = log.read(entry_header.size)
+        if len(header) < entry_header.size:
+            return None
+        magic, sequence, length, checksum = entry_header.unpack(header)
+        if magic != entry_magic:
+            return None
+        payload = log.read(length)
+        if len(payload) < length or zlib.crc32(payload) & 0xffffffff != checksum:
+            return None
+        return sequence, payload
+
+    def _read_entries(self, offset=0):
+        offset = self._entries_offset(offset)
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'rb') as log:
+            log.seek(offset)
+            position = offset
+            while True:
+                entry = self._read_entry(log)
+                if entry is None:
+                    return
+                sequence, payload = entry
+                position += entry_header.size + len(payload)
+                yield sequence, payload, position
+
+    def _open(self):
+        if self.log is None:
+            self.log = open(self.path, 'ab')
+        return self.log
+
+    def append(self, records):
+        """
+        Writes a batch of flights to the log and syncs it to disk.
+        Only called once the batch is known to be storable, every entry of the log is replayed.
+        :param records: List of flight records.
+        :return: Sequence number of the batch.
+        """
+        payload = json.dumps(records).encode('utf-8')
+        with self.lock:
+            sequence = self.sequence + 1
+            log = self._open()
+            write_entry(log, sequence, payload)
+            sync_file(log)
+            self.sequence = sequence
+            self.pending += 1
+            self.size += entry_header.size + len(payload)
+        return sequence
+
+    def entries(self, after_sequence=0, offset=0):
+        """
+        Reads the batches of the log written after a sequence number.
+        :param after_sequence: Sequence of the last batch already applied.
+        :param offset: Size of the start of the log already applied, read from the start when it is not valid.
+        :return: Generator of (sequence, list of flight records), the records are None when they cannot be decoded.
+        """
+        for sequence, payload, end in self._read_entries(offset):
+            if sequence > after_sequence:
+                try:
+                    records = json.loads(payload.decode('utf-8'))
+                except ValueError:
+                    records = None
+                yield sequence, records
+
+    def replay(self, store, offset=0):
+        """
+        Appends to a store the batches of the log it does not hold yet.
+        Batches that cannot be appended are moved to the <log>.rejected file instead.
+        :param store: FlightStore, its wal_sequence is updated.
+        :param offset: Size of the start of the log the store holds the batches of.
+        :return: Tuple of (number of batches replayed, number of batches rejected).
+        """
+        replayed = 0
+        rejected = []
+        for sequence, records in self.entries(store.wal_sequence, offset):
+            if is_valid_batch(records):
+                store.append_batch(records)
+                replayed += 1
+            else:
+                rejected.append(sequence)
+            store.wal_sequence = sequence
+        if rejected:
+            self._reject(set(rejected))
+        return replayed, len(rejected)
+
+    def _reject(self, sequences):
+        with self.lock:
+            with open(self.path + '.rejected', 'ab') as rejected:
+                for sequence, payload, end in self._read_entries():
+                    if sequence in sequences:
+                        write_entry(rejected, sequence, payload)
+                sync_file(rejected)
+            self._rewrite(lambda sequence: sequence not in sequences)
+
+    def copy_entries(self, log, sequence):
+        """
+        Appends the batches of another log up to a sequence, when this log does not hold them yet,
+        and syncs them to disk. Batches keep their sequence numbers.
+        :param log: WriteAheadLog to copy the batches of.
+        :param sequence: Sequence of the last batch to copy.
+        :return: Number of batches copied.
+        """
+        copied = 0
+        with self.lock:
+            for entry_sequence, payload, end in log._read_entries():
+                if self.sequence < entry_sequence <= sequence:
+                    write_entry(self._open(), entry_sequence, payload)
+                    self.sequence = entry_sequence
+                    self.pending += 1
+                    self.size += entry_header.size + len(payload)
+                    copied += 1
+            if copied:
+                sync_file(self.log)
+        return copied
+
+    def discard(self, sequence):
+        """
+        Drops the batches of the log up to a sequence, once they are held by a snapshot.
+        Batches written after it are kept, sequence numbers go on from the last batch of the log.
+        :param sequence: Sequence of the last batch held by the snapshot.
+        """
+        with self.lock:
+            self._rewrite(lambda entry_sequence: entry_sequence > sequence)
+            self.sequence = max(self.sequence, sequence)
+
+    def _rewrite(self, keep):
+        # The kept entries are written to a new file replacing the log, appends reopen it
+        if not os.path.exists(self.path):
+            return
+        temp_path = self.path + '.tmp'
+        kept = 0
+        with open(temp_path, 'wb') as log:
+            for sequence, payload, end in self._read_entries():
+                if keep(sequence):
+                    write_entry(log, sequence, payload)
+                    kept += 1
+            sync_file(log)
+            size = log.tell()
+        self.close()
+        replace_file(temp_path, self.path)
+        self.pending = kept
+        self.size = size
+
+    def close(self):
+        if self.log is not None:
+            self.log.close()
+            self.log = None
@@ -0,0 +1,109 @@
+# Copyright (C) 2015 Edward Wijaya
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""LRU cache of serialized responses
+
+Responses are kept until the cache holds more entries or more bytes
+than its budget, the least recently used ones are evicted first.
+Keys are expected to include the dataset version, so responses of an
+older dataset are never served and simply age out of the cache.
+
+"""
+
+from collections import OrderedDict
+from threading import Lock
+
+
+class ResponseCache(object):
+    """
+    Thread-safe LRU cache of response bodies with an entry and a byte budget.
+    """
+
+    def __init__(self, max_entries=1024, max_bytes=64 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0   # bytes of all cached bodies
+        self.hits = 0
+        self.misses = 0
+        self.lock = Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, count=True):
+        """
+        Returns a cached body and marks it as recently used.
+        :param key: Hashable key of the response.
+        :param count: Whether to count the lookup in the hits or misses,
+                      not when the lookup of the same request was already counted.
+        :return: Cached body, None when the key is not cached.
+        """
+        with self.lock:
+            body = self.entries.pop(key, None)
+            if body is None:
+                if count:
+                    self.misses += 1
+                return None
+            self.entries[key] = body
+            if count:
+                self.hits += 1
+            return body
+
+    def put(self, key, body):
+        """
+        Caches a body, evicting the least recently used ones when over budget.
+        Bodies larger than the whole byte budget are not cached.
+        :param key: Hashable key of the response.
+        :param body: Serialized response body.
+        """
+        if self.max_entries <= 0 or len(body) > self.max_bytes:
+            return
+        with self.lock:
+            previous = self.entries.pop(key, None)
+            if previous is not None:
+                self.size -= len(previous)
+            self.entries[key] = body
+            self.size += len(body)
+
+            while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+                evicted_key, evicted_body = self.entries.popitem(last=False)
+                self.size -= len(evicted_body)
+
+    def clear(self):
+        """
+        Removes every cached body.
+        """
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def stats(self):
+        """
+        Returns the counters of the cache.
+        :return: Dictionary of entries, bytes, hits and misses.
+        """
+        with self.lock:
+            return {'entries': len(self.entries),
+                    'bytes': self.size,
+                    'hits': self.hits,
+                    'misses': self.misses}
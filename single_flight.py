@@ -0,0 +1,189 @@
+# Copyright (C) 2015 Edward Wijaya
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Single-flight coalescing of identical concurrent computations
+
+While a response body is being computed for a key, the other threads
+asking for the same key wait for that computation and get its result
+(or its exception) instead of computing it again.
+
+Across processes, e.g. the workers of flight_server.py, computations
+can also be coalesced through a directory of lock files : the process
+computing a key holds an exclusive flock on the lock file of that key
+only and writes the body next to it, the processes waiting on the lock
+then read that body. Computations of other keys never wait on it.
+Bodies are read back for result_seconds, then removed along with the
+lock files nobody holds. Needs fcntl (not on Windows).
+
+"""
+
+import hashlib
+import os
+import time
+from threading import Event
+from threading import Lock
+from flight_snapshot import replace_file
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+class Call(object):
+    """
+    Computation in progress for a key.
+    """
+    __slots__ = ('done', 'result', 'error')
+
+    def __init__(self):
+        self.done = Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """
+    Thread-safe coalescing of the computations of text bodies by key,
+    optionally across processes through a directory of lock files.
+    """
+
+    def __init__(self, lock_dir=None, result_seconds=5):
+        self.lock_dir = lock_dir if fcntl is not None else None
+        self.result_seconds = result_seconds
+        self.calls = {}     # key -> Call in progress
+        self.computed = 0   # computations run by this process
+        self.coalesced = 0  # callers that waited for a computation of another thread
+        self.shared = 0     # results read from the computation of another process
+        self.lock = Lock()
+        if self.lock_dir is not None and not os.path.isdir(self.lock_dir):
+            os.makedirs(self.lock_dir)
+
+    def do(self, key, compute, shared_key=None, keep=None):
+        """
+        Returns the result of a computation, run once for all the concurrent callers with the same key.
+        :param key: Hashable key of the computation.
+        :param compute: Function returning the body, called without arguments.
+        :param shared_key: String identifying the computation across processes, None to coalesce threads only.
+        :param keep: Function called with a body read from the computation of another process, e.g. to cache it.
+        :return: Body returned by compute.
+        """
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = Call()
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            if shared_key is not None and self.lock_dir is not None:
+                call.result = self._compute_shared(shared_key, compute, keep)
+            else:
+                call.result = compute()
+                with self.lock:
+                    self.computed += 1
+            return call.result
+        except Exception as error:
+            call.error = error
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
+
+    def _compute_shared(self, shared_key, compute, keep=None):
+        digest = hashlib.sha1(shared_key.encode('utf-8')).hexdigest()
+        result_path = os.path.join(self.lock_dir, digest + '.body')
+        with open(os.path.join(self.lock_dir, digest + '.lock'), 'a') as lock_file:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            try:
+                body = self._read_result(result_path)
+                if body is None:
+                    body = compute()
+                    with self.lock:
+                        self.computed += 1
+                    self._write_result(result_path, body)
+                    return body
+            finally:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+        with self.lock:
+            self.shared += 1
+        if keep is not None:
+            keep(body)
+        return body
+
+    def _read_result(self, path):
+        try:
+            if os.path.getmtime(path) < time.time() - self.result_seconds:
+                return None
+            with open(path, 'rb') as result:
+                return result.read().decode('utf-8')
+        except (IOError, OSError):
+            return None
+
+    def _write_result(self, path, body):
+        # Bodies are only kept for the callers waiting on the lock, older ones are removed
+        # along with the lock files of the keys no process is computing
+        expired = time.time() - self.result_seconds
+        for name in os.listdir(self.lock_dir):
+            expired_path = os.path.join(self.lock_dir, name)
+            try:
+                if os.path.getmtime(expired_path) >= expired:
+                    continue
+                if name.endswith('.body'):
+                    os.remove(expired_path)
+                elif name.endswith('.lock'):
+                    self._remove_lock(expired_path)
+            except (IOError, OSError):
+                pass
+
+        temp_path = '%s.%d.tmp' % (path, os.getpid())
+        with open(temp_path, 'wb') as result:
+            result.write(body.encode('utf-8'))
+        replace_file(temp_path, path)
+
+    def _remove_lock(self, path):
+        # A process that opened the file before it is removed computes the key once more at worst
+        with open(path, 'a') as lock_file:
+            try:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except (IOError, OSError):
+                return  # a process is computing the key
+            os.remove(path)
+
+    def stats(self):
+        """
+        Returns the counters of the coalescing.
+        :return: Dictionary of computed, coalesced and shared.
+        """
+        with self.lock:
+            return {'computed': self.computed,
+                    'coalesced': self.coalesced,
+                    'shared': self.shared}
@@ -25,59 +25,424 @@
 
 Available API to use are :
 - GET / (for the list of flights)
+- POST / (to add flights, as a JSON list or one JSON flight per line)
+- GET /?limit=<n>&cursor=<cursor>&fields=<field>,<field> (for a page of flights)
 - GET /arrival_delay/origin/<origin>
 - GET /arrival_delay/origin/<origin>?groupby=<group>
 - GET /cancellation_pct/origin/<origin>
 - GET /cancellation_pct/origin/<origin>?groupby=<group_key>
 
+Group keys can be combined with a comma, e.g. ?groupby=dest,unique_carrier
+groups the flights by every pair of destination and carrier. These groups
+are computed with NumPy when AGGREGATION_ENGINE is 'numpy'.
+Distance groups are segmented every 100 miles by default, use
+?bucket=<miles> for another width or ?buckets=short,medium,long
+for named distance ranges.
+
+The arrival delay can also answer, overall and per group :
+- ?threshold=<minutes> the share of flights more than <minutes> late
+- ?cdf=<minutes> the share of flights at most <minutes> late
+- ?percentile=<percent> the minutes late of a percentile of the flights
+- ?quantiles=1 the estimated p50, p90 and p99 minutes late, from sketches
+  kept per group in bounded memory
+
+Responses carry an ETag of the dataset content and the query, the same
+across restarts and processes serving the same data, a request with a
+matching If-None-Match header gets a 304 Not Modified.
+Identical requests arriving while their response is being computed wait
+for that computation, across the processes of flight_server.py too when
+COALESCE_LOCK_DIR is set.
+
+The flights data is read from one JSON file, or from every JSON file of
+a directory or a glob pattern (FLIGHTS_DATA), loaded in parallel.
+The flights data can be reloaded without a restart, with
+POST /admin/reload (when ADMIN_TOKEN is set, sent as X-Admin-Token)
+or by watching the data file every FLIGHTS_WATCH_INTERVAL seconds.
+
+Flights added with POST / are first written to a write-ahead log
+(FLIGHTS_WAL) and replayed from it on startup and on reload. Every
+WAL_COMPACT_BATCHES batches the logged batches are moved to the ingest
+segment (FLIGHTS_INGEST_SEGMENT), the store is written to its snapshot
+and the log is emptied. The snapshot records the size of the segment
+it holds, so startup only reads the segment past it. The segment is
+replayed on top of the JSON data whenever the snapshot is rebuilt from
+it, so the flights added at runtime outlive a change of the data files.
+
+With FLIGHTS_MAP_SNAPSHOT the columns, origin index and aggregates are read
+in place from the snapshot file mapped read-only, so every server mapping
+it, forked or started on its own, shares one copy of the data. A reload
+publishes a new snapshot file, the servers watching it switch to it.
+
+Run ./flight_server.py to serve from several processes sharing the data,
+or flight_asgi.py (Python 3) to serve from an asyncio event loop.
+
 The source code PEP8 compliant.
 
 """
 
+import base64
+import hashlib
+import hmac
 import json
+import os
+import time
 from collections import defaultdict
-from urlparse import urlparse
-from urlparse import parse_qsl
+from threading import Lock
+from threading import Thread
+try:
+    from urlparse import urlparse
+    from urlparse import parse_qsl
+except ImportError:
+    from urllib.parse import urlparse
+    from urllib.parse import parse_qsl
 from flask import Flask
 from flask import jsonify
 from flask import abort
 from flask import request
 from flask import make_response
+from flask import Response
+from flask.json import dumps as json_dumps
+from flight_aggregates import DistanceBuckets
+from flight_aggregates import aggregate_rows
+from flight_aggregates import combine_aggregates
+import flight_numpy
+from flight_store import FlightStore
+from flight_store import canonical_code
+from flight_store import data_files
+from flight_store import is_valid_batch
+from flight_snapshot import load_snapshot
+from flight_snapshot import snapshot_identity
+from flight_snapshot import snapshot_path
+from flight_snapshot import source_stamp
+from flight_snapshot import write_snapshot
+from flight_wal import WriteAheadLog
+from response_cache import ResponseCache
+from single_flight import SingleFlight
 
 app = Flask(__name__, static_url_path="")
-json_data = open('data/ontime_data_test.json')
-flights_data = json.load(json_data)
+app.config.from_envvar('FLIGHTS_SETTINGS', silent=True)
+app.config.setdefault('FLIGHTS_DATA', 'data/ontime_data_test.json')  # JSON file, directory or glob of JSON files
+app.config.setdefault('FLIGHTS_SNAPSHOT', snapshot_path(app.config['FLIGHTS_DATA']))
+app.config.setdefault('FLIGHTS_LISTING_FIELDS', None)  # other fields kept for GET /, None keeps them all
+app.config.setdefault('FLIGHTS_LOAD_PROCESSES', None)  # processes loading the data files, one per core when None
+app.config.setdefault('FLIGHTS_MAP_SNAPSHOT', False)  # serve the data in place from the shared snapshot file
+app.config.setdefault('FLIGHTS_WAL', os.path.splitext(app.config['FLIGHTS_SNAPSHOT'])[0] + '.wal')
+app.config.setdefault('FLIGHTS_INGEST_SEGMENT', os.path.splitext(app.config['FLIGHTS_SNAPSHOT'])[0] + '.ingest')
+app.config.setdefault('WAL_COMPACT_BATCHES', 1000)  # logged batches written to the snapshot at once, 0 disables
+app.config.setdefault('RESPONSE_CACHE_ENTRIES', 1024)
+app.config.setdefault('RESPONSE_CACHE_BYTES', 64 * 1024 * 1024)
+app.config.setdefault('COALESCE_LOCK_DIR', None)  # lock files coalescing identical requests across processes
+app.config.setdefault('COALESCE_RESULT_SECONDS', 5)  # seconds a body computed by another process is read back
+app.config.setdefault('AGGREGATION_ENGINE', 'python')  # 'numpy' aggregates composite groups with NumPy
+app.config.setdefault('ADMIN_TOKEN', None)  # enables POST /admin/reload when set
+app.config.setdefault('FLIGHTS_WATCH_INTERVAL', 0)  # seconds between checks of the data file, 0 disables
+
+
+def load_flights(data_path, snapshot=None, listing_fields=None):
+    """
+    Loads the flights data, from its binary snapshot when there is an up to date one.
+    Several JSON files are loaded in parallel by FLIGHTS_LOAD_PROCESSES processes,
+    when multiprocessing starts them by forking.
+    With FLIGHTS_MAP_SNAPSHOT the store is served in place from the snapshot file,
+    which is written first when it is missing or out of date.
+    :param data_path: Path of the JSON data file, of a directory or a glob pattern of JSON files.
+    :param snapshot: Path of the snapshot file.
+    :param listing_fields: Other fields to keep for GET /, every field when None.
+    :return: FlightStore holding every flight.
+    """
+    mapped = bool(app.config['FLIGHTS_MAP_SNAPSHOT'] and snapshot)
+    store = load_snapshot(snapshot, data_path, listing_fields, mapped) if snapshot else None
+    if store is None:
+        stamp = source_stamp(data_path)  # hashed, the ETags of the responses derive from it
+        store = FlightStore.from_json_files(data_files(data_path), listing_fields,
+                                            app.config['FLIGHTS_LOAD_PROCESSES'])
+        store.source_stamp = stamp
+        if mapped:
+            # Publish the snapshot, then serve from it like any other process mapping it
+            try:
+                write_snapshot(store, snapshot)
+            except (IOError, OSError):
+                app.logger.exception("Writing the snapshot %s failed, serving a private copy", snapshot)
+                return store
+            store = load_snapshot(snapshot, data_path, listing_fields, mapped) or store
+    return store
+
+
+def replay_ingested(store):
+    """
+    Appends to a store the batches added at runtime it does not hold yet,
+    from the ingest segment past the part the store holds, then from the write-ahead log.
+    Batches that cannot be appended are set aside and logged.
+    :param store: FlightStore, its wal_sequence and ingest_offset are updated.
+    """
+    for log, offset in ((ingest_segment, store.ingest_offset), (flight_wal, 0)):
+        if log is not None:
+            replayed, rejected = log.replay(store, offset)
+            if rejected:
+                app.logger.warning("%d batches of %s cannot be added, moved to %s.rejected",
+                                   rejected, log.path, log.path)
+    if ingest_segment is not None:
+        store.ingest_offset = ingest_segment.size
 
+
+flight_store = load_flights(app.config['FLIGHTS_DATA'], app.config['FLIGHTS_SNAPSHOT'],
+                            app.config['FLIGHTS_LISTING_FIELDS'])
+flight_wal = WriteAheadLog(app.config['FLIGHTS_WAL']) if app.config['FLIGHTS_WAL'] else None
+ingest_segment = None
+if flight_wal is not None and app.config['FLIGHTS_INGEST_SEGMENT']:
+    # Only the part of the segment the snapshot does not hold is read
+    ingest_segment = WriteAheadLog(app.config['FLIGHTS_INGEST_SEGMENT'], flight_store.ingest_offset,
+                                   flight_store.wal_sequence)
+if flight_wal is not None:
+    # Recover the flights added since the snapshot was written
+    replay_ingested(flight_store)
+    flight_wal.sequence = max(flight_wal.sequence, flight_store.wal_sequence)
+reload_lock = Lock()   # held while a new store is being built
+ingest_lock = Lock()   # held while flights are appended to the store
+compact_lock = Lock()  # held while the store is written to the snapshot
+use_numpy_engine = app.config['AGGREGATION_ENGINE'] == 'numpy' and flight_numpy.available
+if app.config['AGGREGATION_ENGINE'] == 'numpy' and not use_numpy_engine:
+    app.logger.warning("NumPy is not installed, groups are aggregated in Python")
+response_cache = ResponseCache(app.config['RESPONSE_CACHE_ENTRIES'], app.config['RESPONSE_CACHE_BYTES'])
+response_flights = SingleFlight(app.config['COALESCE_LOCK_DIR'], app.config['COALESCE_RESULT_SECONDS'])
+
+listing_chunk_rows = 1000  # flights written per chunk of GET /
 distance_range = 100  # segmentation every distance range
+default_distance_buckets = DistanceBuckets(width=distance_range)
+sketch_percentiles = (50, 90, 99)  # percentiles estimated by ?quantiles=1
+query_flags = {'1': True, 'true': True, '0': False, 'false': False}  # values of flags such as ?quantiles=1
+named_distance_ranges = {'short': (0, 500),
+                         'medium': (500, 1500),
+                         'long': (1500, None)}
 allowed_group = {'dest': "Destination",
                  'unique_carrier': "Flight_Carrier",
                  'day_of_week': "Day_of_the_Week",
                  'distance': "Distance"}
 
+
 @app.errorhandler(400)
 def bad_request(error):
     return make_response(jsonify({'error': 'Bad request'}), 400)
 
 
+@app.errorhandler(403)
+def forbidden(error):
+    return make_response(jsonify({'error': 'Forbidden'}), 403)
+
+
 @app.errorhandler(404)
 def not_found(error):
     return make_response(jsonify({'error': 'Not found'}), 404)
 
 
-def make_public_flight(flight):
-    new_flight = {}
-    for field in flight:
-        new_flight[field] = flight[field]
-    return new_flight
+def get_group_query(query_string):
+    """
+    Returns the groups requested with ?groupby=<group_key> and how to segment distances.
+    A ?groupby=<group_key>,<group_key> group is returned as a tuple of group keys.
+    :param query_string: List of (query, query_value) of the request.
+    :return: Tuple of (set of group keys, DistanceBuckets).
+    """
+    # Filter out query string parameters
+    # Process the queries parameter feed
+    # For now, only take the 'groupby' parameter
+    group_keys = set()
+    allowed_group_keys = allowed_group.keys()
+
+    for query, query_value in query_string:
+        if query == "groupby":
+            if query_value in allowed_group_keys:  # matched the group allowed
+                group_keys.add(query_value)
+            elif ',' in query_value:
+                composite_key = []
+                for group_key in query_value.split(','):
+                    if group_key in allowed_group_keys and group_key not in composite_key:
+                        composite_key.append(group_key)
+                if len(composite_key) > 1 and len(composite_key) == len(query_value.split(',')):
+                    group_keys.add(tuple(composite_key))
+
+    return group_keys, get_distance_buckets(query_string)
+
+
+def get_distance_buckets(query_string):
+    """
+    Returns the distance ranges requested with ?bucket=<miles> or ?buckets=<name>,<name>.
+    Aborts with 400 when the requested ranges are not valid.
+    :param query_string: List of (query, query_value) of the request.
+    :return: DistanceBuckets to segment the distance group with.
+    """
+    distance_buckets = default_distance_buckets
+
+    for query, query_value in query_string:
+        if query == "bucket":
+            try:
+                distance_buckets = DistanceBuckets(width=int(query_value))
+            except ValueError:
+                abort(400)
+        elif query == "buckets":
+            names = [name.strip() for name in query_value.split(',') if name.strip()]
+            if not names or any(name not in named_distance_ranges for name in names):
+                abort(400)
+            distance_buckets = DistanceBuckets(
+                ranges=[(name,) + named_distance_ranges[name] for name in set(names)])
+
+    return distance_buckets
 
 
 @app.route('/', methods=['GET'])
 def get_flights():
     """
     This returns a JSON formatted list of flights data with each attribute.
+    The list is streamed in chunks as it is serialized.
+    ?limit=<n> returns a page of at most n flights along with a "next_cursor",
+    to pass as ?cursor=<cursor> for the following page.
+    ?fields=<field>,<field> only returns the given attributes.
     :return: List of flights in JSON format
     """
-    return jsonify({'flights_data': [make_public_flight(flight) for flight in flights_data]})
+    store = flight_store
+    start_row = 0
+    stop_row = len(store)
+    paginated = 'limit' in request.args or 'cursor' in request.args
+
+    if 'cursor' in request.args:
+        start_row = decode_cursor(store, request.args['cursor'])
+    if 'limit' in request.args:
+        try:
+            limit = int(request.args['limit'])
+        except ValueError:
+            abort(400)
+        if limit <= 0:
+            abort(400)
+        stop_row = min(start_row + limit, stop_row)
+
+    fields = None
+    if 'fields' in request.args:
+        fields = set(field.strip() for field in request.args['fields'].split(',') if field.strip())
+        if not fields or not fields.issubset(store.fields_set):
+            abort(400)
+
+    etag = make_etag(store, ('flights', start_row, stop_row, paginated, tuple(sorted(fields)) if fields else None))
+    if request.if_none_match.contains(etag):
+        return not_modified(etag)
+
+    next_cursor = None
+    if paginated:
+        next_cursor = encode_cursor(store, stop_row) if stop_row < len(store) else None
+
+    response = Response(generate_flights(store, start_row, stop_row, fields, paginated, next_cursor),
+                        mimetype='application/json')
+    response.set_etag(etag)
+    return response
+
+
+def cursor_source(store):
+    """
+    Returns what identifies the flights data the rows of a store come from.
+    Flights are only appended, so rows keep their ids until the data files change.
+    Pages are served with strong ETags, the cursors they hold do not depend on the process.
+    :param store: FlightStore the cursor is valid for.
+    :return: Short hexadecimal digest of the source stamp.
+    """
+    return hashlib.sha1(json.dumps(store.source_stamp, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+
+
+def encode_cursor(store, row):
+    """
+    Returns the opaque cursor of a row of the flights list.
+    :param store: FlightStore the cursor is valid for.
+    :param row: Row id the next page starts from.
+    :return: Cursor string.
+    """
+    return base64.urlsafe_b64encode(("%s:%d" % (cursor_source(store), row)).encode('ascii')).decode('ascii')
+
+
+def decode_cursor(store, cursor):
+    """
+    Returns the row a cursor points to. Aborts with 400 when the cursor is not valid,
+    or was given for other flights data.
+    :param store: FlightStore the cursor should be valid for.
+    :param cursor: Cursor string from a previous page.
+    :return: Row id the page starts from.
+    """
+    try:
+        source, row = base64.urlsafe_b64decode(str(cursor)).decode('ascii').split(':')
+        row = int(row)
+    except (TypeError, ValueError):
+        abort(400)
+    if source != cursor_source(store) or not 0 <= row <= len(store):
+        abort(400)
+    return row
+
+
+def generate_flights(store, start_row, stop_row, fields=None, paginated=False, next_cursor=None):
+    """
+    Writes the JSON list of flights chunk by chunk.
+    :param store: FlightStore holding the flights.
+    :param start_row: First row id to write.
+    :param stop_row: Row id to stop before.
+    :param fields: Names of the fields to write, all fields when None.
+    :param paginated: Whether to write the cursor of the next page.
+    :param next_cursor: Cursor of the next page, None on the last page.
+    :return: Generator of chunks of the JSON document.
+    """
+    yield '{"flights_data": ['
+    for chunk_start in range(start_row, stop_row, listing_chunk_rows):
+        chunk_rows = range(chunk_start, min(chunk_start + listing_chunk_rows, stop_row))
+        chunk = ', '.join(store.iter_json(chunk_rows, fields))
+        yield chunk if chunk_start == start_row else ', ' + chunk
+    if paginated:
+        yield '], "next_cursor": ' + json.dumps(next_cursor) + '}'
+    else:
+        yield ']}'
+
+
+@app.route('/', methods=['POST'])
+def post_flights():
+    """
+    Adds a batch of flights, sent as a JSON list of flights or as
+    newline-delimited JSON (one flight per line).
+    The origin index and the aggregates are updated as the flights are added.
+    Needs the ADMIN_TOKEN in the X-Admin-Token header.
+    :return: Number of flights added and in total, in JSON format
+    """
+    check_admin_token()
+
+    records = parse_flight_records(request.get_data())
+    if records is None:
+        abort(400)
+
+    with ingest_lock:
+        store = flight_store
+        if flight_wal is not None:
+            # Every record was checked by parse_flight_records, so the logged batch is replayed as a whole
+            store.wal_sequence = flight_wal.append(records)
+        store.append_batch(records)
+        compact = flight_wal is not None and 0 < app.config['WAL_COMPACT_BATCHES'] <= flight_wal.pending
+    if compact:
+        start_compaction()
+    return make_response(jsonify({'ingested': len(records),
+                                  'flights': len(store),
+                                  'version': store.version,
+                                  'revision': store.revision}), 201)
+
+
+def parse_flight_records(data):
+    """
+    Parses a batch of flights sent as a JSON list or as newline-delimited JSON.
+    :param data: Body of the request.
+    :return: List of flight records, None when the batch is not valid.
+    """
+    try:
+        data = data.decode('utf-8')
+        if data.lstrip().startswith('['):
+            records = json.loads(data)
+        else:
+            records = [json.loads(line) for line in data.splitlines() if line.strip()]
+    except ValueError:
+        return None
+
+    if not is_valid_batch(records):
+        return None
+    return records
 
 
 @app.route('/arrival_delay/origin/<origin>', methods=['GET'])
@@ -96,49 +461,71 @@ def get_arrival_delay(origin):
     # [1] : https://docs.python.org/2/library/urlparse.html#urlparse.urlparse
     query_string = parse_qsl(urlparse(request.url).query)
 
-    # Filter out query string parameters
-    # Process the queries parameter feed
-    # For now, only take the 'groupby' parameter
-    group_keys = set()
-    allowed_group_keys = allowed_group.keys()
+    group_keys, distance_buckets = get_group_query(query_string)
+    delay_queries = get_delay_queries(query_string)
+
+    store = flight_store
+    query_key = response_query_key('arrival_delay', origin, query_string, group_keys, distance_buckets, delay_queries)
+    etag = make_etag(store, query_key)
+    if request.if_none_match.contains(etag):
+        return not_modified(etag)
+
+    body = cached_body(store, query_key,
+                       lambda: render_json(arrival_delay_summary(store, origin, query_string, group_keys,
+                                                                 distance_buckets, delay_queries)))
+    response = Response(body, mimetype='application/json')
+    response.set_etag(etag)
+    return response
 
-    for query, query_value in query_string:
-        if query == "groupby":
-            if query_value in allowed_group_keys:  # matched the group allowed
-                group_keys.add(query_value)
 
-    # Make a list of flights originated from <origin>
-    flights_from_origin = []
-    for flight in flights_data:
-        if flight['origin'] == origin:
-            flights_from_origin.append(flight)
-    if len(flights_from_origin) == 0:
+def arrival_delay_summary(store, origin, query_string, group_keys, distance_buckets, delay_queries=()):
+    """
+    Builds the summary of time delay of flights flying from an <origin> airport.
+    :param store: FlightStore to answer from.
+    :param origin: Origin of airport to check the arrival delay
+    :param query_string: List of (query, query_value) of the request.
+    :param group_keys: Group keys to use for categorization.
+    :param distance_buckets: DistanceBuckets to segment the distance group with.
+    :param delay_queries: List of (threshold|percentile|cdf, value) to answer from the sorted delays.
+    :return: Dictionary of the arrival delay output
+    """
+    # Precomputed aggregates of the flights originated from <origin>
+    origin_aggregates = store.origin_aggregates(origin)
+    if origin_aggregates is None:
         abort(404)
 
     # GET /arrival_delay/origin/<origin> - No query parameters
     if not query_string:
-        overall_delay = []
-        for flight in flights_from_origin:
-            time_of_arrival = int(flight['arr_delay']) if flight['arr_delay'] else None
-            if time_of_arrival is not None and time_of_arrival < 0:
-                overall_delay.append(time_of_arrival)
-
-        earliest_delay = str(abs(max(overall_delay)))
-        longest_delay = str(abs(min(overall_delay)))
-        return jsonify(
-                {'Flying_from': str(origin),
-                 'Output - Expected time of Arrival Delay': earliest_delay + " - " + longest_delay + " minute(s) late"})
+        overall = origin_aggregates.overall
+        if overall.delay_count == 0:
+            abort(404)  # no delayed flights to summarize
+
+        earliest_delay = str(abs(overall.max_delay))
+        longest_delay = str(abs(overall.min_delay))
+        return {'Flying_from': canonical_code(origin),
+                'Output - Expected time of Arrival Delay': earliest_delay + " - " + longest_delay + " minute(s) late"}
 
     # GET /arrival_delay/origin/<origin>?groupby=<group_key>
     else:
-        flights_dictionaries = {'Flying_from': str(origin)}
+        flights_dictionaries = {'Flying_from': canonical_code(origin)}
+        for delay_query in delay_queries:
+            statistic = delay_statistic(origin_aggregates.overall, delay_query)
+            if statistic is not None:
+                flights_dictionaries['Output - ' + delay_statistic_name(delay_query)] = statistic
 
         # Iterate from list of group query
-        for query_key in group_keys:
-            flights_dictionaries['Output - Expected time of Arrival Delay - Group: ' + allowed_group.get(query_key)] \
-                = group_delay(query_key, flights_from_origin)
+        grouped_flights = group_flights(store, origin, origin_aggregates, group_keys, distance_buckets,
+                                        with_delays=any(query != 'quantiles' for query, value in delay_queries),
+                                        with_sketch=any(query == 'quantiles' for query, value in delay_queries))
+        for query_key, groups in grouped_flights.items():
+            flights_dictionaries['Output - Expected time of Arrival Delay - Group: ' + group_name(query_key)] \
+                = group_delay(groups)
+            for delay_query in delay_queries:
+                flights_dictionaries['Output - ' + delay_statistic_name(delay_query) + ' - Group: ' +
+                                     group_name(query_key)] = group_delay_statistic(groups, delay_query)
+
+        return flights_dictionaries
 
-        return jsonify(flights_dictionaries)
 
 @app.route('/cancellation_pct/origin/<origin>', methods=['GET'])
 def get_cancellation_pct(origin):
@@ -155,103 +542,243 @@ def get_cancellation_pct(origin):
     # [1] : https://docs.python.org/2/library/urlparse.html#urlparse.urlparse
     query_string = parse_qsl(urlparse(request.url).query)
 
-    # Filter out query string parameters
-    # Process the queries parameter feed
-    # For now, only take the 'groupby' parameter
-    group_keys = set()
-    allowed_group_keys = allowed_group.keys()
+    group_keys, distance_buckets = get_group_query(query_string)
 
-    for query, query_value in query_string:
-        if query == "groupby":
-            if query_value in allowed_group_keys:  # matched the group allowed
-                group_keys.add(query_value)
+    store = flight_store
+    query_key = response_query_key('cancellation_pct', origin, query_string, group_keys, distance_buckets)
+    etag = make_etag(store, query_key)
+    if request.if_none_match.contains(etag):
+        return not_modified(etag)
 
-    # Make a list of flights originated from <origin>
-    flights = []
-    for flight in flights_data:
-        if flight['origin'].lower() == origin.lower():
-            flights.append(flight)
-    if len(flights) == 0:
+    body = cached_body(store, query_key,
+                       lambda: render_json(cancellation_pct_summary(store, origin, query_string, group_keys,
+                                                                    distance_buckets)))
+    response = Response(body, mimetype='application/json')
+    response.set_etag(etag)
+    return response
+
+
+def cancellation_pct_summary(store, origin, query_string, group_keys, distance_buckets):
+    """
+    Builds the percentage of cancelled flights flying from an <origin> airport.
+    :param store: FlightStore to answer from.
+    :param origin: Origin of airport to check the arrival delay
+    :param query_string: List of (query, query_value) of the request.
+    :param group_keys: Group keys to use for categorization.
+    :param distance_buckets: DistanceBuckets to segment the distance group with.
+    :return: Dictionary of the cancellation percentage output
+    """
+    # Precomputed aggregates of the flights originated from <origin>
+    origin_aggregates = store.origin_aggregates(origin)
+    if origin_aggregates is None:
         abort(404)
 
     # GET /cancellation_pct/origin/<origin> - No query parameters
     if not query_string:
-        flight_dictionaries = {'Flying_from': str(origin)}
-        cancellations_amt = 0.0
-
-        for flight in flights:
-            for field in flight:
-                if field == "cancelled":
-                    if int(flight[field]) == 1:
-                        cancellations_amt += 1
+        flight_dictionaries = {'Flying_from': canonical_code(origin)}
+        overall = origin_aggregates.overall
 
-        cancellations_pct = float(cancellations_amt) / len(flights)
+        cancellations_pct = float(overall.cancelled) / overall.count
         flight_dictionaries['Output - Cancelled Possibility'] = str(("%.2f" % round(cancellations_pct,2)))
-        return jsonify(flight_dictionaries)
+        return flight_dictionaries
 
     # GET /cancellation_pct/origin/<origin>?groupby=<group_key>
     else:
-        flight_dictionaries = {'Flying_from': str(origin)}
+        flight_dictionaries = {'Flying_from': canonical_code(origin)}
 
         # Iterate from list of group query
-        for group_key in group_keys:
-            flight_dictionaries['Output - Cancellation Possibility - Group: ' + allowed_group.get(group_key)] = \
-                group_cancel(group_key, flights)
+        grouped_flights = group_flights(store, origin, origin_aggregates, group_keys, distance_buckets)
+        for group_key, groups in grouped_flights.items():
+            flight_dictionaries['Output - Cancellation Possibility - Group: ' + group_name(group_key)] = \
+                group_cancel(groups)
 
-        return jsonify(flight_dictionaries)
+        return flight_dictionaries
 
 
-def group_delay(group_key, flights):
+def response_query_key(endpoint, origin, query_string, group_keys, distance_buckets, delay_queries=()):
     """
-    Group the arrival delay flights based on keys.
-    :param group_key: Group key to use for categorization.
-    :param flights: List of flights matching from an origin airport.
-    :return: Dictionary containing the list of flights grouped.
+    Returns the normalized query of a response.
+    Responses only depend on the canonical origin, the groups and delay statistics
+    asked for and the flights data they are computed from.
+    :param endpoint: Name of the endpoint.
+    :param origin: Origin airport code as requested.
+    :param query_string: List of (query, query_value) of the request.
+    :param group_keys: Group keys to use for categorization.
+    :param distance_buckets: DistanceBuckets to segment the distance group with.
+    :param delay_queries: List of (threshold|percentile|cdf, value) asked for.
+    :return: Hashable query key.
     """
-    dict_of_group_flights = defaultdict(list)
+    return (endpoint, canonical_code(origin), bool(query_string),
+            tuple(sorted(group_keys, key=repr)), distance_buckets.key(), tuple(sorted(set(delay_queries))))
 
-    if group_key == 'distance':
-        global distance_range   # segmentation every distance range
-
-        # Remove duplicate value & Get the maximum distance
-        distance_set = set()
-        for flight in flights:
-            distance_set.add(int(flight['distance']))
-
-        distance_list = sorted(list(distance_set))
-        max_distance = max(distance_list)
-
-        # Segment into Ranges
-        temp_dict = defaultdict(list)
-        for flight in flights:
-            distance_limit = 0
-            while distance_limit <= max_distance:
-                if int(flight[group_key]) in range(distance_limit, distance_limit + distance_range):
-                    time_of_arrival = int(flight['arr_delay']) if flight['arr_delay'] else None
-                    if time_of_arrival is not None and time_of_arrival < 0:
-                        distance_ranges = str(distance_limit) + " - " + str(distance_limit + distance_range) + " miles"
-                        temp_dict[distance_ranges].append(time_of_arrival)
-                distance_limit += distance_range
 
+def cached_body(store, query_key, compute):
+    """
+    Returns the body of a response from the response cache, computing it on a miss.
+    Responses are cached by query and version of the flights data.
+    Concurrent misses of the same key wait for one computation instead of running
+    their own, across processes too when COALESCE_LOCK_DIR is set.
+    :param store: FlightStore the response is computed from.
+    :param query_key: Normalized query of the response, as returned by response_query_key.
+    :param compute: Function returning the body of the response.
+    :return: Body of the response.
+    """
+    cache_key = query_key + (store.data_version(),)
+    body = response_cache.get(cache_key)
+    if body is not None:
+        return body
+
+    def compute_once():
+        # The previous computation of the key may have finished since the cache was checked,
+        # the miss of this request is already counted
+        body = response_cache.get(cache_key, count=False)
+        if body is None:
+            body = compute()
+            response_cache.put(cache_key, body)
+        return body
+
+    # Dataset versions are numbered per process, the key shared with other processes
+    # is made of the content identity of the data and the query only.
+    # A body computed by another process is cached in this one too.
+    shared_key = make_etag(store, query_key)
+    return response_flights.do(cache_key, compute_once, shared_key, lambda body: response_cache.put(cache_key, body))
+
+
+def make_etag(store, query_key):
+    """
+    Returns the strong ETag of a response, from the content of the flights data
+    rather than its version, which is numbered per process.
+    :param store: FlightStore the response is computed from.
+    :param query_key: Hashable normalized query.
+    :return: ETag value, without quotes.
+    """
+    return hashlib.sha1((store.content_identity() + repr(query_key)).encode('utf-8')).hexdigest()
+
+
+def not_modified(etag):
+    """
+    Returns an empty 304 Not Modified response.
+    :param etag: ETag value of the unchanged response.
+    :return: Response with status 304.
+    """
+    response = Response(status=304)
+    response.set_etag(etag)
+    return response
+
+
+def render_json(payload):
+    """
+    Serializes a response the same way as jsonify.
+    :param payload: Dictionary to serialize.
+    :return: JSON string.
+    """
+    return json_dumps(payload, indent=2, separators=(', ', ': '))
+
+
+def group_name(group_key):
+    """
+    Returns the name of a group shown in the output.
+    :param group_key: Group key, or tuple of group keys of a composite group.
+    :return: Name of the group, e.g. "Destination x Flight_Carrier".
+    """
+    if isinstance(group_key, tuple):
+        return " x ".join(allowed_group.get(key) for key in group_key)
+    return allowed_group.get(group_key)
+
+
+def group_label(store, group_key, value, distance_buckets=default_distance_buckets):
+    """
+    Returns the label of a raw group value shown in the output.
+    :param store: FlightStore the value comes from.
+    :param group_key: Group key of the value.
+    :param value: Raw value, i.e. encoded code, day number or distance.
+    :param distance_buckets: DistanceBuckets to segment the distance group with.
+    :return: Label of the group, None when the value is left out.
+    """
+    if group_key == 'distance':
+        return distance_buckets.label(value)
     elif group_key == 'day_of_week':
-        temp_dict = defaultdict(list)
-        for flight in flights:
-            time_of_arrival = int(flight['arr_delay']) if flight['arr_delay'] else None
-            if time_of_arrival is not None and time_of_arrival < 0:
-                name_of_day = get_day_name(int(flight[group_key]))
-                temp_dict[name_of_day].append(time_of_arrival)
+        return get_day_name(value)
+    return store.dictionaries[group_key].decode(value)
 
-    else:
-        temp_dict = defaultdict(list)
-        for flight in flights:
-            time_of_arrival = int(flight['arr_delay']) if flight['arr_delay'] else None
-            if time_of_arrival is not None and time_of_arrival < 0:
-                temp_dict[flight[group_key]].append(time_of_arrival)
+
+def aggregate_engine(store, rows, groupings, with_delays=False, with_sketch=False):
+    """
+    Aggregates flights by several groupings with the engine set by AGGREGATION_ENGINE.
+    Both engines return the same aggregates.
+    :param store: FlightStore holding the flights.
+    :param rows: Array of row ids of the flights to aggregate.
+    :param groupings: List of tuples of group dimensions.
+    :param with_delays: Whether to keep the sorted delays of the aggregates.
+    :param with_sketch: Whether to keep the delay sketches of the aggregates.
+    :return: List of dictionaries of tuple of raw values -> GroupAggregate, one per grouping.
+    """
+    if use_numpy_engine:
+        # The columns are viewed in place, appending a row has to wait, not a whole batch
+        return flight_numpy.aggregate_rows(store, rows, groupings, with_delays, with_sketch, lock=store.columns_lock)
+    return aggregate_rows(store, rows, groupings, with_delays, with_sketch)
+
+
+def group_flights(store, origin, origin_aggregates, group_keys, distance_buckets=default_distance_buckets,
+                  with_delays=False, with_sketch=False):
+    """
+    Group the flights of an origin airport by every requested key in one go.
+    Both the arrival delay and the cancellation endpoints format their groups from this.
+    Single keys are answered from the precomputed aggregates, composite keys
+    from one pass over the flights of the origin.
+    :param store: FlightStore holding the flights.
+    :param origin: Origin airport code.
+    :param origin_aggregates: OriginAggregates of the origin airport.
+    :param group_keys: Group keys, or tuples of group keys, to use for categorization.
+    :param distance_buckets: DistanceBuckets to segment the distance group with.
+    :param with_delays: Whether the groups need their sorted delays.
+    :param with_sketch: Whether the groups need their delay sketches.
+    :return: Dictionary of group key -> dictionary of group label -> GroupAggregate.
+    """
+    grouped_flights = {}
+
+    for group_key in group_keys:
+        if isinstance(group_key, tuple):
+            continue
+        labelled_groups = defaultdict(list)
+        # Copied at once, flights added meanwhile may add groups
+        for value, aggregate in list(origin_aggregates.groups[group_key].items()):
+            label = group_label(store, group_key, value, distance_buckets)
+            if label is not None:
+                labelled_groups[label].append(aggregate)
+        grouped_flights[group_key] = dict((label, combine_aggregates(aggregates, with_delays, with_sketch))
+                                          for label, aggregates in labelled_groups.items())
+
+    # Composite keys e.g. (dest, unique_carrier), aggregated together in one pass
+    composite_keys = [group_key for group_key in group_keys if isinstance(group_key, tuple)]
+    if composite_keys:
+        composite_groups = aggregate_engine(store, store.origin_rows(origin), composite_keys, with_delays, with_sketch)
+        for group_key, groups in zip(composite_keys, composite_groups):
+            labelled_groups = defaultdict(list)
+            for values, aggregate in groups.items():
+                labels = [group_label(store, key, value, distance_buckets) for key, value in zip(group_key, values)]
+                if None not in labels:
+                    labelled_groups[" | ".join(labels)].append(aggregate)
+            grouped_flights[group_key] = dict((label, combine_aggregates(aggregates, with_delays, with_sketch))
+                                              for label, aggregates in labelled_groups.items())
+
+    return grouped_flights
+
+
+def group_delay(groups):
+    """
+    Format the arrival delay of grouped flights.
+    :param groups: Dictionary of group label -> GroupAggregate.
+    :return: Dictionary containing the list of flights grouped.
+    """
+    dict_of_group_flights = defaultdict(list)
 
     # Overall Arrival Delay in "<minimum> - <maximum> minute(s) late" format
-    for key, delay_list in temp_dict.iteritems():
-        fastest_delay = str(abs(max(delay_list)))
-        longest_delay = str(abs(min(delay_list)))
+    for key, aggregate in groups.items():
+        if aggregate.delay_count == 0:
+            continue
+        fastest_delay = str(abs(aggregate.max_delay))
+        longest_delay = str(abs(aggregate.min_delay))
         if fastest_delay == longest_delay:
             dict_of_group_flights[key].append(fastest_delay + " minute(s) late")
         else:
@@ -260,51 +787,117 @@ def group_delay(group_key, flights):
     return dict_of_group_flights
 
 
-def group_cancel(group_key, flights):
+def get_delay_queries(query_string):
+    """
+    Returns the delay statistics requested with ?threshold=<minutes>, ?percentile=<percent>,
+    ?cdf=<minutes> or ?quantiles=1 (?quantiles=0 leaves them out).
+    Aborts with 400 when a value is not valid.
+    :param query_string: List of (query, query_value) of the request.
+    :return: List of (threshold|percentile|cdf|quantiles, value), in the order of the request.
+    """
+    delay_queries = []
+
+    for query, query_value in query_string:
+        if query in ('threshold', 'cdf'):
+            try:
+                delay_queries.append((query, int(query_value)))
+            except ValueError:
+                abort(400)
+        elif query == 'percentile':
+            try:
+                percent = float(query_value)
+            except ValueError:
+                abort(400)
+            if not 0 <= percent <= 100:
+                abort(400)
+            delay_queries.append((query, percent))
+        elif query == 'quantiles':
+            enabled = query_flags.get(query_value.lower())
+            if enabled is None:
+                abort(400)
+            if enabled:
+                delay_queries.append((query, sketch_percentiles))
+
+    return delay_queries
+
+
+def delay_statistic_name(delay_query):
+    """
+    Returns the name of a delay statistic in the output.
+    :param delay_query: Tuple of (threshold|percentile|cdf|quantiles, value).
+    :return: Name of the statistic.
+    """
+    query, value = delay_query
+    if query == 'threshold':
+        return "Share of Flights more than " + str(value) + " minute(s) late"
+    if query == 'cdf':
+        return "Share of Flights at most " + str(value) + " minute(s) late"
+    if query == 'quantiles':
+        return "Estimated Arrival Delay Percentiles"
+    return "Percentile " + ("%g" % value) + " of Arrival Delay"
+
+
+def minutes_late(minutes):
+    """
+    Format a number of minutes late.
+    :param minutes: Minutes late, negative when early.
+    :return: "<minutes> minute(s) late" or "<minutes> minute(s) early".
+    """
+    if minutes < 0:
+        return str(-minutes) + " minute(s) early"
+    return str(minutes) + " minute(s) late"
+
+
+def delay_statistic(aggregate, delay_query):
+    """
+    Answers a delay statistic from the sorted delays of a group of flights.
+    :param aggregate: GroupAggregate of the flights.
+    :param delay_query: Tuple of (threshold|percentile|cdf|quantiles, value).
+    :return: Formatted statistic, None when no flight has an arrival delay.
+    """
+    query, value = delay_query
+    if query == 'percentile':
+        minutes = aggregate.percentile(value)
+        return None if minutes is None else minutes_late(minutes)
+    if query == 'quantiles':
+        if aggregate.sketch.count == 0:
+            return None
+        return dict(('p%d' % percent, minutes_late(aggregate.estimate_percentile(percent))) for percent in value)
+
+    share = aggregate.share_late(value) if query == 'threshold' else aggregate.share_on_time(value)
+    if share is None:
+        return None
+    return str(("%.2f" % round(share, 2)))
+
+
+def group_delay_statistic(groups, delay_query):
     """
-    Group the cancelled flights based on keys.
-    :param group_key: Group key to use for categorization.
-    :param flights: List of flights matching from an origin airport.
+    Format a delay statistic of grouped flights.
+    :param groups: Dictionary of group label -> GroupAggregate.
+    :param delay_query: Tuple of (threshold|percentile|cdf|quantiles, value).
     :return: Dictionary containing the list of flights grouped.
     """
     dict_of_group_flights = defaultdict(list)
 
-    if group_key == 'distance':
-        global distance_range   # segmentation every distance range
-
-        # Remove duplicate value & Get the maximum distance
-        distance_set = set()
-        for flight in flights:
-            distance_set.add(int(flight['distance']))
-
-        distance_list = sorted(list(distance_set))
-        max_distance = max(distance_list)
-
-        # Segment into Ranges
-        temp_dict = defaultdict(list)
-        for flight in flights:
-            distance_limit = 0
-            while distance_limit <= max_distance:
-                if int(flight[group_key]) in range(distance_limit, distance_limit + distance_range):
-                    distance_ranges = str(distance_limit) + " - " + str(distance_limit + distance_range) + " miles"
-                    temp_dict[distance_ranges].append(int(flight['cancelled']))
-                distance_limit += distance_range
+    for key, aggregate in groups.items():
+        statistic = delay_statistic(aggregate, delay_query)
+        if statistic is not None:
+            dict_of_group_flights[key].append(statistic)
 
-    elif group_key == 'day_of_week':
-        temp_dict = defaultdict(list)
-        for flight in flights:
-            name_of_day = get_day_name(int(flight[group_key]))
-            temp_dict[name_of_day].append(int(flight['cancelled']))
+    return dict_of_group_flights
 
-    else:
-        temp_dict = defaultdict(list)
-        for flight in flights:
-            temp_dict[flight[group_key]].append(int(flight['cancelled']))
+
+def group_cancel(groups):
+    """
+    Format the cancellation percentage of grouped flights.
+    :param groups: Dictionary of group label -> GroupAggregate.
+    :return: Dictionary containing the list of flights grouped.
+    """
+    dict_of_group_flights = defaultdict(list)
 
     # Calculate the cancellation percentage
-    for key, cancellation_list in temp_dict.iteritems():
-        cancellation_amount = list(cancellation_list).count(1)
-        cancellation_percentage = float(cancellation_amount) / len(cancellation_list)
+    for key, aggregate in groups.items():
+        cancellation_percentage = float(aggregate.cancelled) / aggregate.count
         dict_of_group_flights[key].append(str(("%.2f" % round(cancellation_percentage, 2))))
 
     return dict_of_group_flights
@@ -332,5 +925,178 @@ def get_day_name(day_no):
 
     return "NOT_RECOGNIZED"
 
+
+def compact_flights():
+    """
+    Moves the batches of the write-ahead log to the ingest segment,
+    writes the store to the snapshot, then drops from the log the batches
+    the snapshot now holds.
+    Appends are only held off while the number of flights is read, the
+    snapshot is written from a view of the flights up to that number
+    while flights go on being added.
+    Only called with compact_lock held.
+    """
+    try:
+        with ingest_lock:
+            live_store = flight_store
+            rows, fields, wal_sequence = len(live_store), list(live_store.fields), live_store.wal_sequence
+        store = live_store.view(rows, fields)
+        store.wal_sequence = wal_sequence
+        if ingest_segment is not None:
+            ingest_segment.copy_entries(flight_wal, store.wal_sequence)
+            store.ingest_offset = ingest_segment.size
+        write_snapshot(store, app.config['FLIGHTS_SNAPSHOT'])
+        flight_wal.discard(store.wal_sequence)
+        app.logger.info("Flights data compacted up to batch %d", store.wal_sequence)
+    except Exception:
+        app.logger.exception("Compacting the write-ahead log failed")
+    finally:
+        compact_lock.release()
+
+
+def start_compaction():
+    """
+    Starts compacting the write-ahead log in a background thread.
+    :return: False when a compaction is already running.
+    """
+    if not compact_lock.acquire(False):
+        return False
+    thread = Thread(target=compact_flights, name='flights-compact')
+    thread.daemon = True
+    thread.start()
+    return True
+
+
+def reload_flights():
+    """
+    Builds a new store from the flights data and swaps it in.
+    Requests that already hold the previous store finish with it,
+    the following requests get the new one.
+    Flights added at runtime are replayed from the write-ahead log.
+    Only called with reload_lock held.
+    """
+    global flight_store
+    # The log must not be compacted before the new store caught up with it
+    compact_lock.acquire()
+    try:
+        store = load_flights(app.config['FLIGHTS_DATA'], app.config['FLIGHTS_SNAPSHOT'],
+                             app.config['FLIGHTS_LISTING_FIELDS'])
+        replay_ingested(store)
+        with ingest_lock:
+            replay_ingested(store)  # batches added meanwhile
+            flight_store = store
+        app.logger.info("Flights data reloaded, version %d with %d flights", store.version, len(store))
+    except Exception:
+        app.logger.exception("Reloading the flights data failed, keeping version %d", flight_store.version)
+    finally:
+        compact_lock.release()
+        reload_lock.release()
+
+
+def start_reload():
+    """
+    Starts reloading the flights data in a background thread.
+    :return: False when a reload is already running.
+    """
+    if not reload_lock.acquire(False):
+        return False
+    thread = Thread(target=reload_flights, name='flights-reload')
+    thread.daemon = True
+    thread.start()
+    return True
+
+
+def flights_data_stamp():
+    """
+    Returns what identifies the current content of the flights data files.
+    :return: Source stamp without digests, None when the files cannot be read.
+    """
+    try:
+        return source_stamp(app.config['FLIGHTS_DATA'], with_digest=False)
+    except OSError:
+        return None
+
+
+def is_snapshot_published():
+    """
+    Tells whether another snapshot file was published than the one the store is mapped from.
+    :return: True when the store should switch to the current snapshot file.
+    """
+    if not app.config['FLIGHTS_MAP_SNAPSHOT'] or not app.config['FLIGHTS_SNAPSHOT']:
+        return False
+    identity = snapshot_identity(app.config['FLIGHTS_SNAPSHOT'])
+    return identity is not None and identity != flight_store.snapshot_file
+
+
+def watch_flights_data(interval, watch_data=True):
+    """
+    Reloads the flights data whenever one of its files is modified, added or removed,
+    or with FLIGHTS_MAP_SNAPSHOT whenever another process published a new snapshot.
+    :param interval: Seconds between two checks of the files.
+    :param watch_data: Whether to watch the data files, otherwise only the snapshot.
+    """
+    last_stamp = flights_data_stamp() if watch_data else None
+    while True:
+        time.sleep(interval)
+        stamp = flights_data_stamp() if watch_data else None
+        if stamp is not None and stamp != last_stamp:
+            if start_reload():
+                last_stamp = stamp
+        elif is_snapshot_published():
+            start_reload()
+
+
+def start_watcher(interval=None, watch_data=True):
+    """
+    Starts watching the flights data files, every FLIGHTS_WATCH_INTERVAL seconds by default.
+    :param interval: Seconds between two checks of the files, 0 disables.
+    :param watch_data: Whether to watch the data files, otherwise only the snapshot.
+    """
+    if interval is None:
+        interval = app.config['FLIGHTS_WATCH_INTERVAL']
+    if interval > 0:
+        thread = Thread(target=watch_flights_data, args=(interval, watch_data), name='flights-watch')
+        thread.daemon = True
+        thread.start()
+
+
+def check_admin_token():
+    """
+    Aborts with 404 when ADMIN_TOKEN is not set, or with 403 when the
+    X-Admin-Token header of the request does not match it.
+    """
+    admin_token = app.config['ADMIN_TOKEN']
+    if not admin_token:
+        abort(404)
+    if not hmac.compare_digest(token_bytes(request.headers.get('X-Admin-Token', '')), token_bytes(admin_token)):
+        abort(403)
+
+
+def token_bytes(token):
+    """
+    Returns a token as UTF-8 bytes, hmac.compare_digest only compares strings that are ASCII.
+    :param token: Token as a string or bytes.
+    :return: Bytes of the token.
+    """
+    if isinstance(token, bytes):
+        return token
+    return ('%s' % token).encode('utf-8')
+
+
+@app.route('/admin/reload', methods=['POST'])
+def post_reload():
+    """
+    Reloads the flights data in the background without a restart.
+    Needs the ADMIN_TOKEN in the X-Admin-Token header.
+    :return: Version of the flights data being served, in JSON format
+    """
+    check_admin_token()
+
+    started = start_reload()
+    return make_response(jsonify({'reloading': True if started else 'already running',
+                                  'version': flight_store.version}), 202)
+
+
 if __name__ == '__main__':
+    start_watcher()
     app.run(debug=True)
@@ -0,0 +1,142 @@
+# Copyright (C) 2015 Edward Wijaya
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Regression tests of the aggregates
+
+Percentiles read across the sorted delays and the recent ones must match
+a full sort of the delays, and the NumPy engine must compute the same
+aggregates as aggregate_rows.
+
+Run from the root of the repository with :
+    python -m unittest discover tests
+
+"""
+
+import math
+import random
+import unittest
+from array import array
+import flight_numpy
+from flight_aggregates import GroupAggregate
+from flight_aggregates import aggregate_rows
+from flight_aggregates import merged_item
+from flight_aggregates import recent_delays_factor
+from flight_aggregates import recent_delays_min
+from flight_store import FlightStore
+
+percents = (0, 1, 10, 25, 50, 75, 90, 99, 100)
+
+
+def nearest_rank(minutes, percent):
+    ranked = sorted(minutes)
+    rank = int(math.ceil(percent / 100.0 * len(ranked)))
+    return ranked[min(max(rank - 1, 0), len(ranked) - 1)]
+
+
+def random_flights(generator, count):
+    return [{'origin': generator.choice(['LAX', 'JFK']), 'dest': generator.choice(['JFK', 'LAX', 'SFO', 'SEA']),
+             'unique_carrier': generator.choice(['AA', 'DL', 'UA']),
+             'arr_delay': generator.choice(['', str(generator.randint(-60, 300))]),
+             'cancelled': generator.choice('0001'), 'distance': generator.choice(['337', '800', '2475']),
+             'day_of_week': str(generator.randint(1, 7))} for i in range(count)]
+
+
+class MergedItemTest(unittest.TestCase):
+
+    def test_items_match_a_full_sort(self):
+        generator = random.Random(1)
+        for first_length, second_length in [(0, 5), (5, 0), (1, 1), (7, 3), (3, 20), (50, 50)]:
+            first = array('i', sorted(generator.randint(-10, 10) for i in range(first_length)))
+            second = array('i', sorted(generator.randint(-10, 10) for i in range(second_length)))
+            merged = sorted(list(first) + list(second))
+            self.assertEqual([merged_item(first, second, index) for index in range(len(merged))], merged)
+
+
+class RecentDelaysTest(unittest.TestCase):
+
+    def assert_matches(self, aggregate, minutes):
+        delays, recent = aggregate.delay_runs()
+        self.assertEqual(list(recent), sorted(recent))
+        self.assertTrue(len(recent) <= max(recent_delays_min, recent_delays_factor * int(math.sqrt(len(delays)))))
+        self.assertEqual(list(aggregate.sorted_delays()), sorted(minutes))
+        for percent in percents:
+            self.assertEqual(aggregate.percentile(percent), nearest_rank(minutes, percent), percent)
+        self.assertEqual(aggregate.share_late(15), float(sum(1 for late in minutes if late > 15)) / len(minutes))
+
+    def test_percentiles_match_a_full_sort(self):
+        generator = random.Random(2)
+        aggregate = GroupAggregate()
+        minutes = []
+        for count in range(1, 3001):
+            arr_delay = generator.randint(-120, 60)
+            aggregate.add(arr_delay, 0)
+            minutes.append(-arr_delay)
+            if count % 97 == 0 or count < 70:
+                self.assert_matches(aggregate, minutes)
+        self.assert_matches(aggregate, minutes)
+
+    def test_merge_keeps_the_recent_delays(self):
+        generator = random.Random(3)
+        first, second = GroupAggregate(), GroupAggregate()
+        minutes = []
+        for aggregate, count in [(first, 500), (second, 40)]:
+            for i in range(count):
+                arr_delay = generator.randint(-120, 60)
+                aggregate.add(arr_delay, 0)
+                minutes.append(-arr_delay)
+        self.assertTrue(len(second.delay_runs()[1]))
+
+        first.merge(second)
+        self.assert_matches(first, minutes)
+        self.assertEqual(first.count, 540)
+
+
+@unittest.skipUnless(flight_numpy.available, "NumPy is not installed")
+class NumpyEngineTest(unittest.TestCase):
+
+    def assert_same_aggregates(self, expected, actual):
+        self.assertEqual(len(expected), len(actual))
+        for expected_groups, actual_groups in zip(expected, actual):
+            self.assertEqual(sorted(expected_groups), sorted(actual_groups))
+            for key, aggregate in expected_groups.items():
+                other = actual_groups[key]
+                self.assertEqual(aggregate.state()[:5], other.state()[:5], key)
+                delays = aggregate.sorted_delays()
+                other_delays = other.sorted_delays()
+                self.assertEqual(None if delays is None else list(delays),
+                                 None if other_delays is None else list(other_delays), key)
+                sketches = [sketch and (sketch.count, sketch.zero_count, sketch.positive, sketch.negative)
+                            for sketch in (aggregate.sketch, other.sketch)]
+                self.assertEqual(sketches[0], sketches[1], key)
+
+    def test_engines_compute_the_same_aggregates(self):
+        store = FlightStore.from_records(random_flights(random.Random(4), 2000))
+        groupings = [('dest',), ('unique_carrier', 'day_of_week'), ('distance',)]
+        for rows in (array('i', range(len(store))), store.origin_rows('LAX'), array('i')):
+            for with_delays, with_sketch in [(True, True), (True, False), (False, False)]:
+                self.assert_same_aggregates(aggregate_rows(store, rows, groupings, with_delays, with_sketch),
+                                            flight_numpy.aggregate_rows(store, rows, groupings, with_delays,
+                                                                        with_sketch))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,196 @@
+# Copyright (C) 2015 Edward Wijaya
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+"""Regression tests of POST / and FlightStore.append
+
+A flight that cannot be stored must be rejected as a whole, without
+leaving the columns of the store misaligned.
+
+Run from the root of the repository with :
+    python -m unittest discover tests
+
+"""
+
+import io
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from flight_store import FlightStore
+from flight_store import is_valid_record
+from flight_store import iter_json_array
+
+admin_token = 'test-token'
+flights = [{'origin': 'LAX', 'dest': 'JFK', 'unique_carrier': 'AA', 'arr_delay': '-30', 'cancelled': '0',
+            'distance': '2475', 'day_of_week': '3', 'fl_date': '2015-01-02'},
+           {'origin': 'LAX', 'dest': 'SFO', 'unique_carrier': 'UA', 'arr_delay': '5', 'cancelled': '0',
+            'distance': '337', 'day_of_week': '4', 'fl_date': '2015-01-03'},
+           {'origin': 'JFK', 'dest': 'LAX', 'unique_carrier': 'DL', 'arr_delay': '', 'cancelled': '1',
+            'distance': '2475', 'day_of_week': '5', 'fl_date': '2015-01-04'}]
+temp_dir = None
+app_module = None
+
+
+def setUpModule():
+    global temp_dir, app_module
+    temp_dir = tempfile.mkdtemp()
+    data_path = os.path.join(temp_dir, 'flights.json')
+    with open(data_path, 'w') as data:
+        json.dump(flights, data)
+    settings_path = os.path.join(temp_dir, 'settings.cfg')
+    with open(settings_path, 'w') as settings:
+        settings.write('FLIGHTS_DATA = %r\nADMIN_TOKEN = %r\n' % (data_path, admin_token))
+    os.environ['FLIGHTS_SETTINGS'] = settings_path
+    import skyscanner_rest_flight
+    app_module = skyscanner_rest_flight
+
+
+def tearDownModule():
+    shutil.rmtree(temp_dir)
+
+
+def assert_aligned(test, store):
+    for field, column in store.columns.items():
+        test.assertEqual(len(column), len(store), field)
+    test.assertEqual(sum(len(rows) for rows in store.origin_index.values()), len(store))
+
+
+class RecordValidationTest(unittest.TestCase):
+
+    def test_scalars_are_valid(self):
+        self.assertTrue(is_valid_record(dict(flights[0], fl_date=None, fl_num=1234, diverted=False, taxi_in=4.5)))
+
+    def test_lists_and_objects_are_not_valid(self):
+        self.assertFalse(is_valid_record(dict(flights[0], fl_date=['2015-01-01'])))
+        self.assertFalse(is_valid_record(dict(flights[0], fl_date={'day': 1})))
+        self.assertFalse(is_valid_record(dict(flights[0], arr_delay=['-30'])))
+
+    def test_typed_fields_are_coerced(self):
+        self.assertFalse(is_valid_record(dict(flights[0], distance='far')))
+        self.assertFalse(is_valid_record(dict(flights[0], origin=12)))
+
+
+class JsonArrayTest(unittest.TestCase):
+
+    def parse(self, text, chunk_size=4):
+        return list(iter_json_array(io.StringIO(u'' + text), chunk_size))
+
+    def test_items_span_chunks(self):
+        text = json.dumps(flights + [12345, None, 'text'])
+        self.assertEqual(self.parse(text), flights + [12345, None, 'text'])
+        self.assertEqual(self.parse(' [ ]\n'), [])
+
+    def test_invalid_arrays_are_rejected(self):
+        for text in ['[{"a": 1} {"b": 2}]', '[1, 2]x', ']', '[1, ]', '[, 1]', '[1, 2', '{"a": 1}', '']:
+            self.assertRaises(ValueError, self.parse, text)
+
+    def test_syntax_error_stops_reading(self):
+        source = io.StringIO(u'[{"a": 1}, {"b" 2}, ' + u'{"c": 3}, ' * 1000 + u'{}]')
+        self.assertRaises(ValueError, list, iter_json_array(source, 64))
+        self.assertEqual(source.tell(), 64)
+
+
+class AppendTest(unittest.TestCase):
+
+    def test_failed_append_leaves_columns_aligned(self):
+        store = FlightStore.from_records(flights)
+        self.assertRaises(TypeError, store.append, dict(flights[0], fl_date=['2015-01-01']))
+        self.assertRaises(OverflowError, store.append, dict(flights[0], day_of_week='1000'))
+        assert_aligned(self, store)
+        self.assertEqual(len(store), len(flights))
+
+        store.append(flights[0])
+        assert_aligned(self, store)
+        self.assertEqual(store.origin_aggregates('LAX').overall.count, 3)
+
+    def test_view_holds_the_rows_before_later_appends(self):
+        store = FlightStore.from_records(flights)
+        store.append_batch([flights[0]])
+        rows, fields = len(store), list(store.fields)
+        store.append_batch([flights[1], flights[2], dict(flights[0], origin='SEA')])
+
+        view = store.view(rows, fields)
+        assert_aligned(self, view)
+        self.assertEqual(len(view), 4)
+        self.assertEqual(list(view.origin_rows('LAX')), [0, 1, 3])
+        self.assertEqual(view.origin_aggregates('LAX').overall.count, 3)
+        self.assertEqual(view.origin_aggregates('LAX').overall.percentile(50), 30)
+        self.assertIsNone(view.origin_aggregates('SEA'))
+        self.assertEqual(store.origin_aggregates('LAX').overall.count, 4)
+
+    def test_listing_keeps_the_source_values(self):
+        records = [dict(flights[0], distance=2475, cancelled=False, origin='lax'),
+                   dict((field, flights[1][field]) for field in flights[1] if field not in ('cancelled', 'distance')),
+                   dict(flights[2], arr_delay=None, gate='B2')]
+        store = FlightStore.from_records(records[:1])
+        store.append_batch(records[1:])
+        merged = FlightStore.from_records(records[:2])
+        merged.merge(FlightStore.from_records(records[2:]).partition())
+
+        for listed in (store, store.view(3, store.fields), merged):
+            self.assertEqual([json.loads(flight) for flight in listed.iter_json(range(3))], records)
+        self.assertEqual(store.origin_aggregates('LAX').overall.count, 2)
+
+
+class PostFlightsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.client = app_module.app.test_client()
+
+    def post(self, records):
+        return self.client.post('/', data=json.dumps(records), headers={'X-Admin-Token': admin_token})
+
+    def test_list_value_is_rejected(self):
+        store = app_module.flight_store
+        size = len(store)
+        response = self.post([dict(flights[1], fl_date=['2015-01-01'])])
+        self.assertEqual(response.status_code, 400)
+        self.assertIs(app_module.flight_store, store)
+        self.assertEqual(len(store), size)
+        assert_aligned(self, store)
+
+    def test_batch_with_one_bad_record_is_rejected(self):
+        size = len(app_module.flight_store)
+        response = self.post([flights[0], dict(flights[1], fl_num={'number': 1})])
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(len(app_module.flight_store), size)
+        assert_aligned(self, app_module.flight_store)
+
+    def test_non_ascii_token_is_forbidden(self):
+        response = self.client.post('/', data=json.dumps(flights), headers={'X-Admin-Token': u'jet\u00e9'})
+        self.assertEqual(response.status_code, 403)
+
+    def test_valid_batch_is_appended(self):
+        size = len(app_module.flight_store)
+        response = self.post([dict(flights[1], fl_num=4321, taxi_in=None)])
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(len(app_module.flight_store), size + 1)
+        assert_aligned(self, app_module.flight_store)
+
+        listing = json.loads(self.client.get('/').data.decode('utf-8'))
+        self.assertEqual(len(listing['flights_data']), size + 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
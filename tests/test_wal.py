@@ -0,0 +1,126 @@
+# Copyright (C) 2015 Edward Wijaya
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+"""Regression tests of the write-ahead log
+
+Replaying a log must skip the batches that cannot be added to a store,
+and compaction must only drop the batches a snapshot holds.
+
+Run from the root of the repository with :
+    python -m unittest discover tests
+
+"""
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from flight_store import FlightStore
+from flight_wal import WriteAheadLog
+from flight_wal import write_entry
+
+flight = {'origin': 'LAX', 'dest': 'JFK', 'unique_carrier': 'AA', 'arr_delay': '-30', 'cancelled': '0',
+          'distance': '2475', 'day_of_week': '3'}
+
+
+def sequences(log):
+    return [sequence for sequence, records in log.entries()]
+
+
+class WriteAheadLogTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.temp_dir, 'flights.wal')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_file_is_created_on_first_append(self):
+        log = WriteAheadLog(self.path)
+        self.assertFalse(os.path.exists(self.path))
+        self.assertEqual(log.append([flight]), 1)
+        log.close()
+        self.assertEqual(sequences(WriteAheadLog(self.path)), [1])
+
+    def test_replay_rejects_batches_that_cannot_be_added(self):
+        with open(self.path, 'wb') as log:
+            write_entry(log, 1, json.dumps([flight]).encode('utf-8'))
+            write_entry(log, 2, json.dumps([dict(flight, dest=['JFK'])]).encode('utf-8'))
+            write_entry(log, 3, b'not json')
+            write_entry(log, 4, json.dumps([flight, flight]).encode('utf-8'))
+
+        log = WriteAheadLog(self.path)
+        store = FlightStore()
+        self.assertEqual(log.replay(store), (2, 2))
+        self.assertEqual(len(store), 3)
+        self.assertEqual(store.wal_sequence, 4)
+        self.assertEqual(sequences(log), [1, 4])
+        self.assertEqual(sequences(WriteAheadLog(self.path + '.rejected')), [2, 3])
+
+    def test_discard_keeps_later_batches(self):
+        log = WriteAheadLog(self.path)
+        for batch in range(3):
+            log.append([flight])
+        segment = WriteAheadLog(os.path.join(self.temp_dir, 'flights.ingest'))
+        self.assertEqual(segment.copy_entries(log, 2), 2)
+        self.assertEqual(segment.copy_entries(log, 2), 0)
+        log.discard(2)
+        self.assertEqual(sequences(log), [3])
+        self.assertEqual(log.pending, 1)
+        self.assertEqual(log.append([flight]), 4)
+        self.assertEqual(sequences(segment), [1, 2])
+
+        store = FlightStore()
+        segment.replay(store)
+        log.replay(store)
+        self.assertEqual((len(store), store.wal_sequence), (4, 4))
+        log.close()
+        segment.close()
+
+    def test_segment_is_read_past_the_offset_a_snapshot_holds(self):
+        segment = WriteAheadLog(self.path)
+        for batch in range(3):
+            segment.append([flight])
+        held = segment.size
+        segment.append([flight, flight])
+        segment.close()
+
+        store = FlightStore()
+        store.wal_sequence = 3
+        segment = WriteAheadLog(self.path, held, 3)
+        self.assertEqual((segment.sequence, segment.pending), (4, 1))
+        self.assertEqual(segment.replay(store, held), (1, 0))
+        self.assertEqual((len(store), store.wal_sequence), (2, 4))
+
+        # An offset that is not the start of an entry is not trusted, the segment is read from its start
+        store = FlightStore()
+        store.wal_sequence = 3
+        self.assertEqual(WriteAheadLog(self.path, held + 1, 3).size, os.path.getsize(self.path))
+        self.assertEqual(segment.replay(store, held + 1), (1, 0))
+        self.assertEqual(len(store), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()